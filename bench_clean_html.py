@@ -0,0 +1,116 @@
+import argparse
+import json
+import os
+import random
+import time
+
+import qdhtml
+import qdparser
+import qdstream
+
+
+# Сравнение backend'ов FileParser.clean_html: время и побайтовое совпадение результата.
+# Страницы берутся из .html файлов/каталогов или из поля JSON/JSONL выгрузки (--field);
+# без аргументов используется синтетический набор страниц, похожих на страницы сайта.
+#
+#   python bench_clean_html.py pages/ --repeat 3
+#   python bench_clean_html.py export.jsonl --field description --workers 4
+
+
+def load_pages(paths: list[str], field: str) -> list[str]:
+    pages = []
+    for path in paths:
+        if os.path.isdir(path):
+            for file_path in qdparser.FileParser.list_files(path):
+                pages.extend(load_pages([file_path], field))
+        elif path.endswith(('.json', '.jsonl', '.ndjson')):
+            for record in qdstream.iter_json_records(path):
+                if isinstance(record, dict) and isinstance(record.get(field), str):
+                    pages.append(record[field])
+        else:
+            with open(path, 'r', encoding='utf-8', errors='replace') as file:
+                pages.append(file.read())
+    return pages
+
+
+def synthetic_pages(count: int, seed: int = 0) -> list[str]:
+    rng = random.Random(seed)
+    words = ("курс обучение 1С:Бухгалтерия зарплата отчёт налог сотрудник программа "
+             "\"Управление торговлей\" преподаватель&nbsp;сертификат расписание").split()
+
+    def paragraph():
+        text = " ".join(rng.choice(words) for _ in range(rng.randint(20, 80)))
+        link = rng.choice(['<a href="/courses/1c-buh/">курс</a>', '<a href="https://1c.ru/news">новости</a>',
+                           '<a class="btn">записаться</a>', ''])
+        return f'<p class="text" style="margin:0">{text} {link}<br>{text[:60]}&nbsp;&laquo;ok&raquo;</p>\n'
+
+    pages = []
+    for _ in range(count):
+        body = "".join(
+            f'<div class="block"><h2 id="s{i}">Раздел {i}</h2>\n'
+            + "".join(paragraph() for _ in range(rng.randint(2, 6)))
+            + '<ul>' + "".join(f'<li><span>пункт {j}</span></li>' for j in range(rng.randint(1, 5))) + '</ul>'
+            + '<img src="/img/logo.png" alt="logo"></div>\n'
+            for i in range(rng.randint(2, 8)))
+        pages.append(f'<html><head><style>p {{ color: red; }}</style></head><body>{body}</body></html>')
+    return pages
+
+
+def run_backend(pages: list[str], backend: str, repeat: int) -> tuple[float, list[str]]:
+    best = float('inf')
+    results = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        results = [qdhtml.clean_html(page, "https://www.1c-uc3.ru", backend=backend) for page in pages]
+        best = min(best, time.perf_counter() - start)
+    return best, results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк backend'ов очистки HTML")
+    parser.add_argument('paths', nargs='*')
+    parser.add_argument('--field', default='description')
+    parser.add_argument('--synthetic', type=int, default=300)
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    pages = load_pages(args.paths, args.field) if args.paths else synthetic_pages(args.synthetic)
+    if not pages:
+        raise ValueError("Не найдено ни одной страницы для замера.")
+    size_mb = sum(len(page.encode('utf-8')) for page in pages) / 1e6
+
+    report = {'pages': len(pages), 'megabytes': round(size_mb, 2), 'backends': {}}
+    reference = None
+    for backend in qdhtml.BACKENDS:
+        elapsed, results = run_backend(pages, backend, args.repeat)
+        if reference is None:
+            reference = results
+        mismatches = sum(1 for left, right in zip(reference, results) if left != right)
+        report['backends'][backend] = {
+            'seconds': round(elapsed, 4),
+            'pages_per_second': round(len(pages) / elapsed, 1),
+            'megabytes_per_second': round(size_mb / elapsed, 2),
+            'mismatches': mismatches,
+        }
+
+    if args.workers != 1:
+        start = time.perf_counter()
+        qdparser.FileParser.clean_html_many(pages, workers=args.workers)
+        elapsed = time.perf_counter() - start
+        report['clean_html_many'] = {
+            'workers': args.workers or os.cpu_count(),
+            'seconds': round(elapsed, 4),
+            'pages_per_second': round(len(pages) / elapsed, 1),
+        }
+
+    text = json.dumps(report, ensure_ascii=False, indent=4)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(text)
+
+
+if __name__ == '__main__':
+    main()
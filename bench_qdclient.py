@@ -0,0 +1,292 @@
+import argparse
+import asyncio
+import datetime
+import hashlib
+import json
+import platform
+import random
+import time
+import tracemalloc
+import typing
+
+import numpy
+import qdrant_client
+import qdrant_client.models
+
+import qdoperator
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+# Офлайн-бенчмарк QdClient: локальный режим qdrant_client (":memory:") и детерминированные
+# эмбеддеры с искусственной задержкой, без сети и ключей. Для каждого корпуса замеряются запись
+# (add_points), обновление (update_points), одиночный и пакетный поиск; результат - JSON,
+# который удобно сравнивать между запусками.
+#
+#   python bench_qdclient.py --points 2000 --queries 200 --latency 0.05 --output bench.json
+
+
+WORDS = ("зарплата отчёт перенос данных ошибка выгрузка загрузка камин бюджет налог сотрудник "
+         "начисление отпуск больничный справка квартал увольнение премия касса банк договор "
+         "учреждение версия обновление конфигурация документ проводка период страховые взносы "
+         "курс обучение преподаватель программа сертификат бухгалтерия торговля склад").split()
+
+
+class FakeVectorInfo(qdoperator.VectorInfo):
+    # Детерминированный эмбеддер: вектор зависит только от текста, каждый запрос к «модели»
+    # ждёт latency + latency_per_text * len(texts) секунд
+    def __init__(self, name: str, size: int, name_for_embed: str, type_of_object: typing.Type[qdoperator.DataObject],
+                 latency: float = 0., latency_per_text: float = 0., batch_size: int = 256):
+        super().__init__(name, size, name_for_embed, None, type_of_object, model="fake", batch_size=batch_size)
+        self.latency = latency
+        self.latency_per_text = latency_per_text
+        self.requests = 0
+
+    async def _embed_batch(self, texts: list[str], model: str) -> list[list[float]]:
+        self.requests += 1
+        await asyncio.sleep(self.latency + self.latency_per_text * len(texts))
+        return [self.fake_embedding(text) for text in texts]
+
+    def fake_embedding(self, text: str) -> list[float]:
+        seed = int.from_bytes(hashlib.blake2b(text.encode("utf-8"), digest_size=8).digest(), "little")
+        vector = numpy.random.default_rng(seed).standard_normal(self.size)
+        return (vector / numpy.linalg.norm(vector)).tolist()
+
+
+class CountingQdrant:
+    # Прокси над AsyncQdrantClient: считает вызовы (round trips) по именам методов
+    def __init__(self, qdrant: qdrant_client.AsyncQdrantClient):
+        self._qdrant = qdrant
+        self.calls: dict[str, int] = {}
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self._qdrant, name)
+        if not asyncio.iscoroutinefunction(attribute):
+            return attribute
+
+        async def counted(*args, **kwargs):
+            self.calls[name] = self.calls.get(name, 0) + 1
+            return await attribute(*args, **kwargs)
+        return counted
+
+    def take(self) -> dict[str, int]:
+        calls, self.calls = self.calls, {}
+        return calls
+
+
+def sentence(rng: random.Random, low: int, high: int) -> str:
+    # Распределение слов близко к закону Ципфа, как в живых текстах
+    return " ".join(WORDS[min(int(rng.paretovariate(1.2)) - 1, len(WORDS) - 1)] if rng.random() < 0.7
+                    else rng.choice(WORDS) for _ in range(rng.randint(low, high)))
+
+
+def tokens_of(text: str) -> list[str]:
+    return list(dict.fromkeys(text.split()))[:20]
+
+
+def alex_corpus(count: int, rng: random.Random) -> list[dict]:
+    records = []
+    for i in range(count):
+        question = sentence(rng, 8, 30)
+        records.append({
+            'type_source': qdoperator.TypeOfSource.SITE.value,
+            'source': f"https://forum.example.ru/thread/{i}",
+            'tokens': tokens_of(question),
+            'category_name': rng.choice(["Зарплата", "Бухгалтерия", "Кадры"]),
+            'thread_name': sentence(rng, 3, 8),
+            'question': question,
+            'answer': sentence(rng, 30, 120),
+        })
+    return records
+
+
+def wiki_corpus(count: int, rng: random.Random) -> list[dict]:
+    records = []
+    for i in range(count):
+        content = sentence(rng, 60, 200)
+        records.append({
+            'content': content,
+            'type_source': qdoperator.TypeOfSource.TXT_FILE.value,
+            'source': f"project{i % 7}()Wiki{i // 5}.txt",
+            'tokens': tokens_of(content),
+            'title': f"project{i % 7} Wiki{i // 5} - часть {i % 5 + 1}",
+            'project': f"project{i % 7}",
+            'name': f"Wiki{i // 5}",
+            'chunk_index': i % 5,
+        })
+    return records
+
+
+def course_corpus(count: int, rng: random.Random) -> list[dict]:
+    records = []
+    for i in range(count):
+        name = sentence(rng, 3, 8)
+        records.append({
+            'type_source': qdoperator.TypeOfSource.SITE.value,
+            'source': f"https://www.1c-uc3.ru/courses/{i}/",
+            'tokens': tokens_of(name),
+            'course_id': i,
+            'course_name': name,
+            'course_level': rng.choice(["базовый", "углублённый", None]),
+            'course_teacher': [sentence(rng, 2, 2)],
+            'course_novelty': rng.random() < 0.1,
+            'course_announcement': sentence(rng, 20, 60),
+            'course_accent': None,
+            'course_announce': sentence(rng, 10, 30),
+            'course_for_who': sentence(rng, 5, 15),
+            'course_after': [sentence(rng, 4, 10) for _ in range(3)],
+            'course_notes': None,
+            'course_moretext': sentence(rng, 40, 150),
+            'course_program_block': [sentence(rng, 5, 20) for _ in range(5)],
+            'course_url': f"https://www.1c-uc3.ru/courses/{i}/",
+            'course_formats': ["очно", "онлайн"],
+        })
+    return records
+
+
+# Корпус: (тип объекта, генератор, векторизуемые поля, поля сравнения для update_points, изменяемое поле)
+CORPORA = {
+    'alex': (qdoperator.AlexQuestion, alex_corpus, ['question', 'answer'], ['source'], 'answer'),
+    'wiki': (qdoperator.RedmineWikiObject, wiki_corpus, ['content'], ['source', 'chunk_index'], 'content'),
+    'course': (qdoperator.UcCourseObject, course_corpus, ['course_name', 'course_moretext'], ['course_id'],
+               'course_moretext'),
+}
+
+
+def percentiles(latencies: list[float]) -> dict:
+    if not latencies:
+        return {}
+    values = numpy.percentile(numpy.array(latencies) * 1000, [50, 95, 99])
+    return {'p50_ms': round(float(values[0]), 3), 'p95_ms': round(float(values[1]), 3),
+            'p99_ms': round(float(values[2]), 3)}
+
+
+class Measure:
+    # Время, пиковая память (tracemalloc) и число обращений к Qdrant и к модели за один этап
+    def __init__(self, counter: CountingQdrant, vectors: list[FakeVectorInfo], memory: bool):
+        self.counter = counter
+        self.vectors = vectors
+        self.memory = memory
+        self.result = {}
+
+    def __enter__(self):
+        self.counter.take()
+        self.requests_before = sum(vector.requests for vector in self.vectors)
+        if self.memory:
+            tracemalloc.start()
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.result['seconds'] = round(time.perf_counter() - self.started_at, 4)
+        if self.memory:
+            self.result['peak_memory_mb'] = round(tracemalloc.get_traced_memory()[1] / 2 ** 20, 2)
+            tracemalloc.stop()
+        self.result['round_trips'] = self.counter.take()
+        self.result['embedding_requests'] = sum(vector.requests for vector in self.vectors) - self.requests_before
+
+
+async def bench_corpus(corpus: str, args: argparse.Namespace) -> dict:
+    type_of_object, generate, embed_fields, compare_fields, changed_field = CORPORA[corpus]
+    rng = random.Random(args.seed)
+    records = generate(args.points, rng)
+    queries = [sentence(rng, 2, 6) for _ in range(args.queries)]
+
+    client = qdoperator.QdClient(location=":memory:")
+    counter = CountingQdrant(client.qdrant)
+    client.qdrant = counter
+    vectors = [FakeVectorInfo(f"{field}-fake", args.dim, field, type_of_object, args.latency, args.latency_per_text)
+               for field in embed_fields]
+    await client.create_collection(
+        collection_name=corpus, vector_config=vectors, type_of_object=type_of_object,
+        payload_index=[{'name': 'tokens', 'schema': qdrant_client.models.PayloadSchemaType.KEYWORD}],
+        natural_ids=True)
+    report = {'points': len(records), 'queries': len(queries)}
+
+    with Measure(counter, vectors, args.memory) as measure:
+        await client.add_points(records, corpus, batch_size=args.batch_size)
+    measure.result['points_per_second'] = round(len(records) / measure.result['seconds'], 1)
+    report['ingest'] = measure.result
+
+    # Повторная загрузка: меняется каждая десятая запись, остальные должны отсекаться по хэшам
+    updated = [dict(record, **{changed_field: record[changed_field] + " изменено"}) if i % 10 == 0 else record
+               for i, record in enumerate(records)]
+    with Measure(counter, vectors, args.memory) as measure:
+        await client.update_points(updated, corpus, compare_fields=compare_fields, fields_to_check=embed_fields,
+                                   batch_size=args.batch_size)
+    measure.result['points_per_second'] = round(len(records) / measure.result['seconds'], 1)
+    report['update'] = measure.result
+
+    searches = {
+        'search': lambda text: client.search(text, corpus, embed_fields[0], limit=args.limit),
+        'hybrid_search': lambda text: client.hybrid_search(text, corpus, embed_fields, limit=args.limit,
+                                                           fusion='rrf'),
+    }
+    for name, search in searches.items():
+        client.query_cache.clear()
+        latencies = []
+        with Measure(counter, vectors, args.memory) as measure:
+            for text in queries:
+                started_at = time.perf_counter()
+                await search(text)
+                latencies.append(time.perf_counter() - started_at)
+        measure.result.update(percentiles(latencies))
+        measure.result['queries_per_second'] = round(len(queries) / measure.result['seconds'], 1)
+        report[name] = measure.result
+
+    batched = {
+        'search_many': lambda: client.search_many(queries, corpus, embed_fields[0], limit=args.limit),
+        'hybrid_search_many': lambda: client.hybrid_search_many(queries, corpus, embed_fields, limit=args.limit,
+                                                                fusion='rrf'),
+    }
+    for name, search in batched.items():
+        client.query_cache.clear()
+        with Measure(counter, vectors, args.memory) as measure:
+            await search()
+        measure.result['queries_per_second'] = round(len(queries) / measure.result['seconds'], 1)
+        report[name] = measure.result
+
+    await counter.close()
+    return report
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Офлайн-бенчмарк загрузки и поиска QdClient")
+    parser.add_argument('--corpus', nargs='*', default=list(CORPORA), choices=list(CORPORA))
+    parser.add_argument('--points', type=int, default=1000)
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('--limit', type=int, default=5)
+    parser.add_argument('--batch-size', type=int, default=100)
+    parser.add_argument('--latency', type=float, default=0.02, help="задержка одного запроса к модели, с")
+    parser.add_argument('--latency-per-text', type=float, default=0.0002, help="добавка на каждый текст, с")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--memory', action='store_true',
+                        help="пиковая память этапов через tracemalloc (заметно замедляет замеры времени)")
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    report = {
+        'started_at': datetime.datetime.now().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'settings': vars(args),
+        'corpora': {},
+    }
+    for corpus in args.corpus:
+        report['corpora'][corpus] = await bench_corpus(corpus, args)
+    if resource is not None:
+        # ru_maxrss в Linux - в килобайтах
+        report['max_rss_mb'] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+    text = json.dumps(report, ensure_ascii=False, indent=4)
+    print(text)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as file:
+            file.write(text)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
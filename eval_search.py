@@ -0,0 +1,213 @@
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import time
+import typing
+
+import numpy
+import qdrant_client.models
+
+import bench_qdclient
+import qdoperator
+import qdstream
+
+
+# Подбор параметров search/hybrid_search по соотношению полноты и задержки. Эталон для каждого
+# запроса - точный поиск (exact=True, полный перебор) по опорному векторному полю; каждая
+# конфигурация сетки сравнивается с ним по recall@k и MRR (место эталонного первого результата).
+# В конце выбирается самая быстрая конфигурация, у которой recall@k не ниже --target.
+#
+#   python eval_search.py --corpus alex --points 5000 --queries 200 --target 0.95
+#   python eval_search.py --records export.jsonl --corpus wiki --query-file queries.txt --host localhost
+#
+# В локальном режиме (":memory:") qdrant_client всегда ищет перебором: hnsw_ef и квантизация
+# на результат не влияют, их имеет смысл перебирать только на сервере (--host).
+
+
+def expand_grid(method: str, grid: dict[str, list]) -> list[dict]:
+    # {"hnsw_ef": [16, 64], "fusion": [None, "rrf"]} -> все сочетания значений
+    keys = list(grid)
+    return [{'method': method, **dict(zip(keys, values))} for values in itertools.product(*grid.values())]
+
+
+def describe(config: dict) -> str:
+    return " ".join(f"{key}={value}" for key, value in config.items() if value is not None)
+
+
+def recall_at_k(found: list, relevant: list, k: int) -> float:
+    relevant = set(relevant[:k])
+    if not relevant:
+        return 1.
+    return len(relevant.intersection(found[:k])) / len(relevant)
+
+
+def reciprocal_rank(found: list, relevant: list) -> float:
+    if not relevant:
+        return 1.
+    for rank, point_id in enumerate(found, start=1):
+        if point_id == relevant[0]:
+            return 1. / rank
+    return 0.
+
+
+async def ground_truth(client: qdoperator.QdClient, queries: list[str], collection_name: str, using: str,
+                       k: int) -> list[list]:
+    results = await client.search_many(queries, collection_name, using, limit=k, exact=True)
+    return [[point.id for point in points] for points in results]
+
+
+async def warm_up(client: qdoperator.QdClient, queries: list[str], collection_name: str):
+    # Эмбеддинги и токены запросов одинаковы для всех конфигураций: считаем их заранее,
+    # чтобы задержка отражала только работу Qdrant
+    config = client.collection_configs[collection_name]
+    for vector in config["vector_config"]:
+        await client.embed_queries(vector, queries)
+    if config["payload_index"]:
+        for text in queries:
+            client.query_tokenizer.tokenize(text)
+
+
+async def evaluate(client: qdoperator.QdClient, config: dict, queries: list[str], truth: list[list],
+                   collection_name: str, fields: list[str], k: int) -> dict:
+    params = {key: value for key, value in config.items() if key != 'method'}
+    if config['method'] == 'search':
+        search = lambda text: client.search(text, collection_name, fields[0], limit=k, **params)
+    elif config['method'] == 'hybrid_search':
+        search = lambda text: client.hybrid_search(text, collection_name, fields, limit=k, **params)
+    else:
+        raise ValueError(f"Некорректный метод поиска: {config['method']}")
+
+    latencies = []
+    recalls = []
+    ranks = []
+    for text, relevant in zip(queries, truth):
+        started_at = time.perf_counter()
+        points = await search(text)
+        latencies.append(time.perf_counter() - started_at)
+        found = [point.id for point in points]
+        recalls.append(recall_at_k(found, relevant, k))
+        ranks.append(reciprocal_rank(found, relevant))
+
+    p50, p95 = numpy.percentile(numpy.array(latencies) * 1000, [50, 95])
+    return {
+        'config': config,
+        f'recall@{k}': round(float(numpy.mean(recalls)), 4),
+        'mrr': round(float(numpy.mean(ranks)), 4),
+        'p50_ms': round(float(p50), 3),
+        'p95_ms': round(float(p95), 3),
+    }
+
+
+async def sweep(client: qdoperator.QdClient, collection_name: str, queries: list[str], fields: list[str],
+                configs: list[dict], k: int = 5, truth: list[list] | None = None) -> list[dict]:
+    # truth - размеченные id релевантных points по запросам; по умолчанию - точный поиск по fields[0]
+    if truth is None:
+        truth = await ground_truth(client, queries, collection_name, fields[0], k)
+    await warm_up(client, queries, collection_name)
+    return [await evaluate(client, config, queries, truth, collection_name, fields, k) for config in configs]
+
+
+def cheapest(results: list[dict], target: float, k: int) -> dict | None:
+    passing = [result for result in results if result[f'recall@{k}'] >= target]
+    return min(passing, key=lambda result: result['p50_ms']) if passing else None
+
+
+def load_queries(path: str) -> list[str]:
+    with open(path, 'r', encoding='utf-8') as file:
+        return [line.strip() for line in file if line.strip()]
+
+
+def parse_optional(values: list[str], cast: typing.Callable) -> list:
+    return [None if value == 'none' else cast(value) for value in values]
+
+
+def parse_flag(value: str) -> bool:
+    if value not in ('on', 'off'):
+        raise argparse.ArgumentTypeError("ожидается on или off")
+    return value == 'on'
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Оценка полноты и задержки параметров поиска QdClient")
+    parser.add_argument('--corpus', default='alex', choices=list(bench_qdclient.CORPORA))
+    parser.add_argument('--records', default=None, help="JSON/JSONL с записями вместо синтетического корпуса")
+    parser.add_argument('--points', type=int, default=2000)
+    parser.add_argument('--query-file', default=None, help="по одному запросу в строке")
+    parser.add_argument('--queries', type=int, default=100)
+    parser.add_argument('--dim', type=int, default=256)
+    parser.add_argument('-k', type=int, default=5)
+    parser.add_argument('--quantization', default=None, choices=list(qdoperator.QUANTIZATION_MODES))
+    parser.add_argument('--host', default=None, help="сервер Qdrant вместо локального режима")
+    parser.add_argument('--port', type=int, default=6333)
+    parser.add_argument('--key', default=None)
+    parser.add_argument('--hnsw-ef', nargs='*', default=['none', '16', '64', '128'])
+    parser.add_argument('--prefetch', nargs='*', default=['none', '20', '50'])
+    parser.add_argument('--fusion', nargs='*', default=['none', 'rrf', 'dbsf', qdoperator.FUSION_WEIGHTED])
+    parser.add_argument('--token-filter', nargs='*', type=parse_flag, default=[True, False])
+    parser.add_argument('--oversampling', nargs='*', default=['none'])
+    parser.add_argument('--rescore', nargs='*', type=parse_flag, default=None)
+    parser.add_argument('--target', type=float, default=0.95, help="требуемый recall@k")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default=None)
+    args = parser.parse_args()
+
+    type_of_object, generate, fields, _, _ = bench_qdclient.CORPORA[args.corpus]
+    rng = random.Random(args.seed)
+    if args.records:
+        records = list(qdstream.iter_json_records(args.records))
+    else:
+        records = generate(args.points, rng)
+    queries = load_queries(args.query_file) if args.query_file else [
+        bench_qdclient.sentence(rng, 2, 6) for _ in range(args.queries)]
+
+    if args.host:
+        client = qdoperator.QdClient(args.host, args.port, args.key)
+    else:
+        client = qdoperator.QdClient(location=":memory:")
+    vectors = [bench_qdclient.FakeVectorInfo(f"{field}-fake", args.dim, field, type_of_object)
+               for field in fields]
+    for vector in vectors:
+        vector.quantization = args.quantization and qdoperator.QUANTIZATION_MODES[args.quantization]
+    collection_name = f"eval_{args.corpus}"
+    await client.delete_collection(collection_name)
+    await client.create_collection(
+        collection_name=collection_name, vector_config=vectors, type_of_object=type_of_object,
+        payload_index=[{'name': 'tokens', 'schema': qdrant_client.models.PayloadSchemaType.KEYWORD}],
+        natural_ids=True)
+    await client.add_points(records, collection_name)
+
+    hnsw_ef = parse_optional(args.hnsw_ef, int)
+    oversampling = parse_optional(args.oversampling, float)
+    rescore = args.rescore or [None]
+    configs = expand_grid('search', {'hnsw_ef': hnsw_ef, 'oversampling': oversampling, 'rescore': rescore})
+    configs += expand_grid('hybrid_search', {
+        'hnsw_ef': hnsw_ef,
+        'prefetch_limit': parse_optional(args.prefetch, int),
+        'fusion': parse_optional(args.fusion, str),
+        'token_filter': args.token_filter,
+        'oversampling': oversampling,
+        'rescore': rescore,
+    })
+
+    results = await sweep(client, collection_name, queries, fields, configs, args.k)
+    best = cheapest(results, args.target, args.k)
+    for result in sorted(results, key=lambda result: result['p50_ms']):
+        print(f"{result[f'recall@{args.k}']:.3f}  mrr {result['mrr']:.3f}  p50 {result['p50_ms']:8.3f} ms  "
+              f"{describe(result['config'])}")
+    if best is None:
+        print(f"Ни одна конфигурация не достигла recall@{args.k} >= {args.target}")
+    else:
+        print("Лучшая конфигурация:", describe(best['config']))
+
+    if args.output:
+        report = {'settings': vars(args), 'points': len(records), 'queries': len(queries),
+                  'results': results, 'best': best}
+        with open(args.output, 'w', encoding='utf-8') as file:
+            json.dump(report, file, ensure_ascii=False, indent=4)
+    await client.delete_collection(collection_name)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -1,8 +1,7 @@
 import asyncio
 import config
-import qdoperator, qdparser
+import qdoperator, qdparser, qdstream
 import init_clients
-import json
 from tqdm import tqdm
 
 async def main():
@@ -34,24 +33,13 @@ async def main():
 
     file_parser = qdparser.FileParser()
 
-    with open('example_data.json', 'r', encoding='utf-8') as f:
-        content =  json.load(f)
-
-    await client.add_points(points_batch=content,collection_name='Alex')
-
-
-
-    # Process in batches of 100
-    batch_size = 100
-    total_records = len(content)
-    total_batches = (total_records + batch_size - 1) // batch_size
-
-    for i in tqdm(range(0, total_records, batch_size), total=total_batches, desc="Processing batches"):
-        # Get current batch
-        batch = content[i:i + batch_size]
-
-        # Upload batch
-        await client.add_points(points_batch=batch, collection_name='Alex')
+    with tqdm(desc="Processing records", unit="records") as progress:
+        await qdstream.ingest_file(
+            client=client,
+            path='example_data.json',
+            collection_name='Alex',
+            batch_size=100,
+            on_batch=progress.update)
 
 if __name__ == "__main__":
     asyncio.run(main())
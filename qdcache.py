@@ -0,0 +1,210 @@
+import asyncio
+import collections
+import hashlib
+import logging
+import sqlite3
+import threading
+import time
+import typing
+import unicodedata
+
+import numpy
+
+
+class EmbeddingCache:
+    # Постоянный кэш эмбеддингов между запусками. Ключ - хэш от (имя вектора, модель, размерность,
+    # нормализованный текст), значение - float32 вектор в BLOB. При превышении max_entries
+    # вытесняются записи, к которым дольше всего не обращались.
+    def __init__(self, path: str, max_entries: int = 1_000_000, mmap_size: int = 256 * 1024 * 1024):
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        self._connection.execute(f"PRAGMA mmap_size={int(mmap_size)}")
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, accessed_at REAL NOT NULL)")
+        self._connection.execute(
+            "CREATE INDEX IF NOT EXISTS embeddings_accessed_at ON embeddings (accessed_at)")
+        self._connection.commit()
+        self._entries = self._connection.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+    @staticmethod
+    def normalize_text(text: str) -> str:
+        return " ".join(unicodedata.normalize("NFC", text).split())
+
+    @classmethod
+    def make_key(cls, vector_name: str, model: str | None, size: int, text: str) -> str:
+        raw = "\x1f".join((vector_name, model or "", str(size), cls.normalize_text(text)))
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def get_many(self, keys: list[str]) -> dict[str, list[float]]:
+        if not keys:
+            return {}
+
+        found = {}
+        with self._lock:
+            unique_keys = list(dict.fromkeys(keys))
+            # Ограничение SQLite на число параметров в одном запросе
+            for i in range(0, len(unique_keys), 500):
+                chunk = unique_keys[i: i + 500]
+                rows = self._connection.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({', '.join('?' * len(chunk))})",
+                    chunk).fetchall()
+                for key, blob in rows:
+                    found[key] = numpy.frombuffer(blob, dtype=numpy.float32).tolist()
+
+            if found:
+                now = time.time()
+                self._connection.executemany(
+                    "UPDATE embeddings SET accessed_at = ? WHERE key = ?",
+                    [(now, key) for key in found])
+                self._connection.commit()
+
+            hits = sum(1 for key in keys if key in found)
+            self.hits += hits
+            self.misses += len(keys) - hits
+
+        return found
+
+    def set_many(self, items: dict[str, list[float]]):
+        if not items:
+            return
+
+        with self._lock:
+            now = time.time()
+            before = self._connection.total_changes
+            self._connection.executemany(
+                "INSERT OR IGNORE INTO embeddings (key, vector, accessed_at) VALUES (?, ?, ?)",
+                [(key, numpy.asarray(vector, dtype=numpy.float32).tobytes(), now) for key, vector in items.items()])
+            self._entries += self._connection.total_changes - before
+
+            if self._entries > self.max_entries:
+                excess = self._entries - self.max_entries
+                self._connection.execute(
+                    "DELETE FROM embeddings WHERE key IN "
+                    "(SELECT key FROM embeddings ORDER BY accessed_at LIMIT ?)", (excess,))
+                self._entries -= excess
+                logging.debug(f"Из кэша эмбеддингов вытеснено {excess} записей.")
+
+            self._connection.commit()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.,
+            'entries': self._entries,
+        }
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class QueryEmbeddingCache:
+    # Кэш эмбеддингов поисковых запросов в памяти процесса: LRU с ограничением размера и TTL.
+    # Одновременные запросы с одинаковым ключом ждут один и тот же вызов модели.
+    def __init__(self, max_size: int = 10_000, ttl: float = 3600.):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+        self._items: collections.OrderedDict[typing.Hashable, tuple[float, list[float]]] = collections.OrderedDict()
+        self._in_flight: dict[typing.Hashable, asyncio.Future] = {}
+
+    async def get_or_compute(self, key: typing.Hashable,
+                             factory: typing.Callable[[], typing.Awaitable[list[float]]]) -> list[float]:
+        embedding = self._lookup(key)
+        if embedding is not None:
+            return embedding
+
+        task = self._in_flight.get(key)
+        if task is None:
+            self.misses += 1
+            task = self._start(key, factory())
+        else:
+            self.coalesced += 1
+
+        # shield: отмена одного из ожидающих не должна отменять вычисление для остальных
+        return await asyncio.shield(task)
+
+    async def get_or_compute_many(
+            self, keys: list[typing.Hashable],
+            factory: typing.Callable[[list[typing.Hashable]], typing.Awaitable[list[list[float]]]]
+    ) -> list[list[float]]:
+        # Все промахи считаются одним вызовом factory, результаты - в порядке keys
+        found = {}
+        waiting = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            embedding = self._lookup(key)
+            if embedding is not None:
+                found[key] = embedding
+            elif key in self._in_flight:
+                self.coalesced += 1
+                waiting[key] = self._in_flight[key]
+            else:
+                missing.append(key)
+
+        if missing:
+            self.misses += len(missing)
+            batch = asyncio.ensure_future(factory(missing))
+            for index, key in enumerate(missing):
+                waiting[key] = self._start(key, self._pick(batch, index))
+
+        if waiting:
+            results = await asyncio.shield(asyncio.gather(*waiting.values()))
+            found.update(zip(waiting, results))
+        return [found[key] for key in keys]
+
+    @staticmethod
+    async def _pick(batch: asyncio.Future, index: int) -> list[float]:
+        return (await batch)[index]
+
+    def _lookup(self, key: typing.Hashable) -> list[float] | None:
+        item = self._items.get(key)
+        if item is None:
+            return None
+        expires_at, embedding = item
+        if expires_at <= time.monotonic():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        return embedding
+
+    def _start(self, key: typing.Hashable, coroutine: typing.Awaitable[list[float]]) -> asyncio.Future:
+        task = asyncio.ensure_future(coroutine)
+        self._in_flight[key] = task
+        task.add_done_callback(lambda done: self._finish(key, done))
+        return task
+
+    def _finish(self, key: typing.Hashable, task: asyncio.Future):
+        self._in_flight.pop(key, None)
+        if task.cancelled() or task.exception() is not None or self.max_size <= 0:
+            return
+
+        self._items[key] = (time.monotonic() + self.ttl, task.result())
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_size:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+
+    def stats(self) -> dict:
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'coalesced': self.coalesced,
+            'size': len(self._items),
+        }
@@ -0,0 +1,129 @@
+import collections
+import re
+import typing
+
+
+HEADER_PATTERN = re.compile(r'^h[2-3]\..*', flags=re.MULTILINE)
+
+
+def estimate_tokens(text: str) -> int:
+    # Грубая оценка сверху: для кириллицы токенайзеры OpenAI дают ~2-3 символа на токен.
+    # Её же использует VectorInfo.estimate_tokens для бюджета батчей эмбеддингов
+    return len(text) // 2 + 1
+
+
+class TiktokenCounter:
+    # Точный подсчёт токенов моделей OpenAI. tiktoken - необязательная зависимость, импортируется
+    # при первом вызове; в дочерние процессы передаётся только имя кодировки.
+    def __init__(self, encoding_name: str = "cl100k_base"):
+        self.encoding_name = encoding_name
+        self._encoding = None
+
+    def __call__(self, text: str) -> int:
+        if self._encoding is None:
+            import tiktoken
+            self._encoding = tiktoken.get_encoding(self.encoding_name)
+        return len(self._encoding.encode(text, disallowed_special=()))
+
+    def __getstate__(self) -> dict:
+        return {'encoding_name': self.encoding_name}
+
+    def __setstate__(self, state: dict):
+        self.__init__(state['encoding_name'])
+
+
+class TextChunker:
+    # Разбиение документа на чанки не длиннее max_tokens токенов (count_tokens - любой счётчик,
+    # например TiktokenCounter или len для ограничения в символах). Текст режется по абзацам,
+    # слишком длинные абзацы - по строкам, затем по словам; соседние части склеиваются, пока
+    # помещаются в лимит. Последние части чанка на overlap_tokens повторяются в начале следующего.
+    # Каждая часть считается токенайзером один раз, длина чанка - сумма длин частей
+    # и separator_tokens на каждый пробел между ними.
+    def __init__(self, max_tokens: int = 512, overlap_tokens: int = 0,
+                 count_tokens: typing.Callable[[str], int] = estimate_tokens, separator_tokens: int = 0):
+        if max_tokens <= 0:
+            raise ValueError("max_tokens должен быть положительным.")
+        if not 0 <= overlap_tokens < max_tokens:
+            raise ValueError("overlap_tokens должен быть неотрицательным и меньше max_tokens.")
+        self.max_tokens = max_tokens
+        self.overlap_tokens = overlap_tokens
+        self.count_tokens = count_tokens
+        self.separator_tokens = separator_tokens
+
+    @staticmethod
+    def iter_sections(content: str) -> typing.Iterator[str]:
+        if len(content) <= 512:
+            yield content.strip()
+            return
+
+        starts = (match.start() for match in HEADER_PATTERN.finditer(content))
+        if next(starts, None) is None:
+            yield content.strip()
+            return
+
+        # Текст до первого заголовка остаётся в одном блоке с первым разделом
+        previous = 0
+        for start in starts:
+            yield content[previous:start].strip()
+            previous = start
+        yield content[previous:].strip()
+
+    def chunk_document(self, content: str) -> typing.Iterator[tuple[int, int, str]]:
+        # (номер блока, номер чанка в блоке, текст)
+        for idx_block, block in enumerate(self.iter_sections(content)):
+            for idx_chunk, chunk in enumerate(self.chunk_text(block)):
+                yield idx_block, idx_chunk, chunk
+
+    def chunk_text(self, text: str) -> typing.Iterator[str]:
+        window: collections.deque[tuple[str, int]] = collections.deque()
+        window_tokens = 0
+
+        for piece, tokens in self.iter_pieces(text):
+            if self._length(window, window_tokens + tokens, 1) > self.max_tokens:
+                if window:
+                    yield " ".join(part for part, _ in window)
+                    while window and self._length(window, window_tokens) > self.overlap_tokens:
+                        window_tokens -= window.popleft()[1]
+                # Перекрытие не должно выталкивать следующую часть за лимит
+                while window and self._length(window, window_tokens + tokens, 1) > self.max_tokens:
+                    window_tokens -= window.popleft()[1]
+
+            window.append((piece, tokens))
+            window_tokens += tokens
+
+        if window:
+            yield " ".join(part for part, _ in window)
+
+    def _length(self, window: collections.deque, tokens: int, extra_pieces: int = 0) -> int:
+        return tokens + self.separator_tokens * max(0, len(window) + extra_pieces - 1)
+
+    def iter_pieces(self, text: str) -> typing.Iterator[tuple[str, int]]:
+        for paragraph in text.split("\n\n"):
+            yield from self._split(paragraph, ("\n", None))
+
+    def _split(self, text: str, separators: tuple) -> typing.Iterator[tuple[str, int]]:
+        text = text.strip()
+        if not text:
+            return
+
+        tokens = self.count_tokens(text)
+        if tokens <= self.max_tokens:
+            yield text, tokens
+        elif separators:
+            for part in text.split(separators[0]):
+                yield from self._split(part, separators[1:])
+        else:
+            yield from self._split_word(text, tokens)
+
+    def _split_word(self, word: str, tokens: int) -> typing.Iterator[tuple[str, int]]:
+        # Одно «слово» длиннее лимита (ссылка, base64 и т.п.) режется по символам
+        step = max(1, len(word) * self.max_tokens // tokens)
+        start = 0
+        while start < len(word):
+            piece = word[start: start + step]
+            piece_tokens = self.count_tokens(piece)
+            if piece_tokens > self.max_tokens and len(piece) > 1:
+                step = max(1, step // 2)
+                continue
+            yield piece, piece_tokens
+            start += len(piece)
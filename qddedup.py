@@ -0,0 +1,143 @@
+import re
+import typing
+import zlib
+
+import numpy
+
+
+MODE_DROP = "drop"
+MODE_LINK = "link"
+
+WORD_PATTERN = re.compile(r"\w+", flags=re.UNICODE)
+MERSENNE_PRIME = numpy.uint64((1 << 61) - 1)
+
+
+def choose_bands(threshold: float, num_perm: int) -> tuple[int, int]:
+    # Порог срабатывания LSH примерно (1 / bands) ** (1 / rows): берём ближайший снизу к threshold,
+    # чтобы почти не терять пары выше порога, а лишних кандидатов отсеивает проверка сигнатур
+    best = (num_perm, 1)
+    for rows in range(1, num_perm + 1):
+        if num_perm % rows:
+            continue
+        bands = num_perm // rows
+        if (1 / bands) ** (1 / rows) <= threshold:
+            best = (bands, rows)
+    return best
+
+
+class NearDuplicateFilter:
+    # Поиск почти одинаковых текстов (цитаты в ответах, повторяющиеся шаблоны, скопированные ответы)
+    # по MinHash-сигнатурам словесных шинглов и LSH-корзинам. Состояние живёт всё время загрузки,
+    # поэтому дубликаты находятся и между батчами. Первый встреченный текст становится каноническим,
+    # source дубликата запоминается в merged_sources по id канонического point. В режиме "drop"
+    # дубликаты просто не записываются, в режиме "link" их источники ещё и дописываются
+    # в payload merged_sources канонического point. Канонический point может записываться параллельно
+    # с его дубликатами (ingest_file с несколькими workers), поэтому merged_sources отдаются
+    # на запись только после confirm - когда сам point уже записан в Qdrant.
+    def __init__(self, threshold: float = 0.85, num_perm: int = 128, shingle_size: int = 3,
+                 mode: str = MODE_DROP, fields: list[str] | None = None, seed: int = 1):
+        if mode not in (MODE_DROP, MODE_LINK):
+            raise ValueError(f"Неизвестный режим дедупликации: {mode}. Допустимые: {MODE_DROP}, {MODE_LINK}")
+        if not 0 < threshold <= 1:
+            raise ValueError("threshold должен быть в диапазоне (0, 1].")
+
+        self.threshold = threshold
+        self.num_perm = num_perm
+        self.shingle_size = shingle_size
+        self.mode = mode
+        self.fields = fields
+        self.bands, self.rows = choose_bands(threshold, num_perm)
+
+        generator = numpy.random.default_rng(seed)
+        self._a = generator.integers(1, 1 << 32, size=(num_perm, 1), dtype=numpy.uint64)
+        self._b = generator.integers(0, 1 << 32, size=(num_perm, 1), dtype=numpy.uint64)
+        self._buckets: list[dict[bytes, list[str]]] = [{} for _ in range(self.bands)]
+        self._signatures: dict[str, numpy.ndarray] = {}
+
+        self.merged_sources: dict[str, list[str]] = {}
+        self.dirty: set[str] = set()
+        self.written: set[str] = set()
+        self.seen = 0
+        self.duplicates = 0
+
+    def shingles(self, text: str) -> set[str]:
+        words = WORD_PATTERN.findall(text.lower())
+        if len(words) <= self.shingle_size:
+            return {" ".join(words)} if words else set()
+        return {" ".join(words[i: i + self.shingle_size]) for i in range(len(words) - self.shingle_size + 1)}
+
+    def signature(self, text: str) -> numpy.ndarray | None:
+        shingles = self.shingles(text)
+        if not shingles:
+            return None
+        hashes = numpy.fromiter((zlib.crc32(shingle.encode("utf-8")) for shingle in shingles),
+                                dtype=numpy.uint64, count=len(shingles))
+        # a, b и хэши меньше 2^32, поэтому a * h + b не переполняет uint64
+        values = (self._a * hashes + self._b) % MERSENNE_PRIME
+        return (values.min(axis=1) & numpy.uint64(0xFFFFFFFF)).astype(numpy.uint32)
+
+    def find(self, signature: numpy.ndarray) -> str | None:
+        checked = set()
+        for band, bucket in enumerate(self._buckets):
+            key = signature[band * self.rows: (band + 1) * self.rows].tobytes()
+            for point_id in bucket.get(key, ()):
+                if point_id in checked:
+                    continue
+                checked.add(point_id)
+                if numpy.mean(self._signatures[point_id] == signature) >= self.threshold:
+                    return point_id
+        return None
+
+    def add(self, point_id: str, signature: numpy.ndarray):
+        self._signatures[point_id] = signature
+        for band, bucket in enumerate(self._buckets):
+            key = signature[band * self.rows: (band + 1) * self.rows].tobytes()
+            bucket.setdefault(key, []).append(point_id)
+
+    def check(self, point_id: str, text: str | None, source: str | None = None) -> str | None:
+        # Возвращает id канонического point, если текст - почти дубликат уже встреченного
+        self.seen += 1
+        signature = self.signature(text) if text else None
+        if signature is None:
+            return None
+
+        canonical_id = self.find(signature)
+        if canonical_id is None:
+            self.add(point_id, signature)
+            return None
+        if canonical_id == point_id:
+            return None
+
+        self.duplicates += 1
+        if source is not None:
+            sources = self.merged_sources.setdefault(canonical_id, [])
+            if source not in sources:
+                sources.append(source)
+                if self.mode == MODE_LINK:
+                    self.dirty.add(canonical_id)
+        return canonical_id
+
+    def text_of(self, data_object, default_fields: list[str]) -> str:
+        values = (getattr(data_object, field, None) for field in self.fields or default_fields)
+        return "\n".join(str(value) for value in values if value)
+
+    def confirm(self, point_ids: typing.Iterable[str]):
+        # Points записаны в Qdrant: к каноническим из них теперь можно дописывать merged_sources
+        self.written.update(point_id for point_id in point_ids if point_id in self._signatures)
+
+    def take_dirty(self) -> dict[str, list[str]]:
+        # Записанные канонические points, у которых с прошлого вызова появились новые merged_sources;
+        # остальные ждут своего confirm
+        ready = self.dirty & self.written
+        self.dirty -= ready
+        return {point_id: list(self.merged_sources[point_id]) for point_id in ready}
+
+    def stats(self) -> dict:
+        return {
+            'seen': self.seen,
+            'duplicates': self.duplicates,
+            'canonical': len(self._signatures),
+            'linked': len(self.merged_sources),
+            'merged_sources': sum(len(sources) for sources in self.merged_sources.values()),
+            'pending_links': len(self.dirty),
+        }
@@ -0,0 +1,227 @@
+import functools
+import logging
+import typing
+
+import bs4
+import bs4.builder
+import bs4.builder._htmlparser
+import bs4.dammit
+import bs4.element
+
+
+UNWRAP_TAGS = {'p', 'div', 'span', 'img', 'br'}
+CDATA_TAGS = {'script', 'style'}
+
+# StreamingCleaner опирается на внутренний BeautifulSoupHTMLParser. Версии bs4, на которых его результат
+# сверен с clean_html_soup на tests/golden_html; на остальных backend 'stream' работает через bs4
+STREAM_TESTED_BS4 = ('4.15',)
+SELF_CHECK_HTML = ('<div class="x"><p>Текст&nbsp;&laquo;ok&raquo; <a href="/courses/">курс</a><a>без ссылки</a>'
+                   '<br><b>a &amp; b</b></p><script>if (a < b) {}</script><ul><li>пункт<li>ещё</ul>\r\n'
+                   '<!-- комментарий --><img src="/i.png"></div></span>')
+
+
+class UnsupportedMarkup(Exception):
+    # Разметка, для которой потоковый разбор не гарантирует совпадение с bs4
+    pass
+
+
+def resolve_link(link: str, base_url: str, url_transformer: typing.Callable[[str], str] | None = None) -> str:
+    if link.startswith('/') or not (link.startswith('http://') or link.startswith('https://')):
+        if base_url.endswith('/') and link.startswith('/'):
+            link = base_url + link[1:]
+        else:
+            link = base_url + ('' if base_url.endswith('/') or link.startswith('/') else '/') + link
+
+    if url_transformer is not None:
+        link = url_transformer(link)
+    return link
+
+
+def finalize_text(result: str) -> str:
+    result = result.replace('\xa0', ' ').replace('&nbsp;', ' ')
+    result = result.replace('\r\n', '\n')
+    result = result.replace(' "', " «").replace('"', "»")
+    return result
+
+
+def clean_html_soup(html, base_url: str, url_transformer=None) -> str:
+    soup = bs4.BeautifulSoup(html, 'html.parser')
+    for a_tag in soup.find_all('a'):
+        link = a_tag.get('href')
+        if link:
+            a_tag.replace_with(soup.new_string(resolve_link(link, base_url, url_transformer)))
+        else:
+            a_tag.decompose()
+
+    for tag in soup.find_all(list(UNWRAP_TAGS)):
+        tag.unwrap()
+
+    for tag in soup.find_all(True):
+        tag.attrs = {}
+
+    return finalize_text(str(soup))
+
+
+class _OpenTag:
+    __slots__ = ('name', 'mode', 'is_empty_element')
+
+    def __init__(self, name: str, mode: str, is_empty_element: bool):
+        self.name = name
+        self.mode = mode
+        self.is_empty_element = is_empty_element
+
+
+class StreamingCleaner:
+    # Потоковая замена clean_html_soup: токенизатор тот же (BeautifulSoupHTMLParser из bs4),
+    # но вместо построения дерева и трёх обходов по нему результат пишется сразу по событиям
+    # парсера. Повторяет правила bs4: закрытие тегов по стеку, схлопывание пробельных строк,
+    # экранирование текста вне script/style, вывод пустых элементов как <br/>.
+    # Вложенные <a> bs4 обрабатывает с ошибкой - для них поднимается UnsupportedMarkup.
+    builder = bs4.builder.HTMLParserTreeBuilder()
+    ASCII_SPACES = bs4.BeautifulSoup.ASCII_SPACES
+
+    def __init__(self, base_url: str, url_transformer=None):
+        self.base_url = base_url
+        self.url_transformer = url_transformer
+        self.contains_replacement_characters = False
+
+        self.output: list[str] = []
+        self.current_data: list[str] = []
+        self.stack: list[_OpenTag] = []
+        self.open_tag_counter: dict[str, int] = {}
+        self.dropped = 0
+        self.preserved = 0
+
+    def clean(self, html: str) -> str:
+        parser = bs4.builder._htmlparser.BeautifulSoupHTMLParser(self, convert_charrefs=False)
+        try:
+            parser.feed(html)
+            parser.close()
+        except AssertionError as error:
+            raise UnsupportedMarkup(error)
+
+        self.endData()
+        while self.stack:
+            self.pop_tag()
+        return finalize_text("".join(self.output))
+
+    def handle_starttag(self, name, namespace, nsprefix, attrs, sourceline=None, sourcepos=None,
+                        namespaces=None) -> _OpenTag:
+        self.endData()
+
+        is_empty_element = name in self.builder.empty_element_tags
+        if self.dropped:
+            if name == 'a':
+                raise UnsupportedMarkup("вложенный тег <a>")
+            mode = 'drop'
+        elif name == 'a':
+            link = attrs.get('href')
+            if link:
+                self.output.append(self.escape(resolve_link(link, self.base_url, self.url_transformer)))
+            mode = 'drop'
+        elif name in UNWRAP_TAGS:
+            mode = 'unwrap'
+        else:
+            mode = 'keep'
+            self.output.append(f"<{name}/>" if is_empty_element else f"<{name}>")
+
+        tag = _OpenTag(name, mode, is_empty_element)
+        self.stack.append(tag)
+        self.open_tag_counter[name] = self.open_tag_counter.get(name, 0) + 1
+        if mode == 'drop':
+            self.dropped += 1
+        if name in self.builder.preserve_whitespace_tags:
+            self.preserved += 1
+        return tag
+
+    def handle_endtag(self, name, nsprefix=None):
+        self.endData()
+        if not self.open_tag_counter.get(name):
+            return
+        while self.stack:
+            if self.pop_tag().name == name:
+                break
+
+    def pop_tag(self) -> _OpenTag:
+        tag = self.stack.pop()
+        self.open_tag_counter[tag.name] -= 1
+        if tag.mode == 'drop':
+            self.dropped -= 1
+        elif tag.mode == 'keep' and not tag.is_empty_element:
+            self.output.append(f"</{tag.name}>")
+        if tag.name in self.builder.preserve_whitespace_tags:
+            self.preserved -= 1
+        return tag
+
+    def handle_data(self, data: str):
+        self.current_data.append(data)
+
+    def endData(self, containerClass=None):
+        if not self.current_data:
+            return
+
+        data = "".join(self.current_data)
+        self.current_data = []
+        if not self.preserved and all(char in self.ASCII_SPACES for char in data):
+            data = "\n" if "\n" in data else " "
+
+        if self.dropped:
+            return
+        if containerClass is not None and issubclass(containerClass, bs4.element.PreformattedString):
+            self.output.append(containerClass.PREFIX + data + containerClass.SUFFIX)
+        elif self.parent_name() in CDATA_TAGS:
+            self.output.append(data)
+        else:
+            self.output.append(self.escape(data))
+
+    def parent_name(self) -> str | None:
+        for tag in reversed(self.stack):
+            if tag.mode == 'keep':
+                return tag.name
+        return None
+
+    @staticmethod
+    def escape(text: str) -> str:
+        return bs4.dammit.EntitySubstitution.substitute_xml(text)
+
+
+@functools.cache
+def stream_supported() -> bool:
+    version = ".".join(bs4.__version__.split(".")[:2])
+    if version not in STREAM_TESTED_BS4:
+        logging.warning(f"Потоковая очистка HTML не проверена на bs4 {bs4.__version__}, используется bs4.")
+        return False
+
+    # Самопроверка на случай изменений внутри bs4 в пределах проверенной версии
+    base_url = "https://www.1c-uc3.ru"
+    try:
+        supported = StreamingCleaner(base_url).clean(SELF_CHECK_HTML) == clean_html_soup(SELF_CHECK_HTML, base_url)
+    except Exception:
+        supported = False
+    if not supported:
+        logging.warning(f"Потоковая очистка HTML расходится с bs4 {bs4.__version__}, используется bs4.")
+    return supported
+
+
+def clean_html_stream(html, base_url: str, url_transformer=None) -> str:
+    # Байтовые строки требуют определения кодировки - это делает только bs4
+    if not isinstance(html, str) or not stream_supported():
+        return clean_html_soup(html, base_url, url_transformer)
+    try:
+        return StreamingCleaner(base_url, url_transformer).clean(html)
+    except UnsupportedMarkup:
+        return clean_html_soup(html, base_url, url_transformer)
+
+
+BACKENDS = {
+    'bs4': clean_html_soup,
+    'stream': clean_html_stream,
+}
+
+
+def clean_html(html, base_url: str, url_transformer=None, backend: str = 'stream') -> str | None:
+    if html is None:
+        return None
+    if backend not in BACKENDS:
+        raise ValueError(f"Неизвестный backend очистки HTML: {backend}. Допустимые: {', '.join(BACKENDS)}")
+    return BACKENDS[backend](html, base_url, url_transformer)
@@ -0,0 +1,265 @@
+import asyncio
+import bisect
+import contextlib
+import functools
+import inspect
+import threading
+import time
+import typing
+
+
+class Exporter:
+    # Приёмник метрик. span - необязательный контекст вокруг операции (трейсинг),
+    # observe - длительность завершённой операции, increment - счётчик
+    def span(self, name: str, labels: dict) -> typing.ContextManager | None:
+        return None
+
+    def observe(self, name: str, labels: dict, seconds: float, error: bool):
+        pass
+
+    def increment(self, name: str, labels: dict, value: float):
+        pass
+
+
+class Metrics:
+    # Точка сбора метрик для всех модулей (как logging): пока не подключён ни один экспортер,
+    # timer возвращает общий пустой контекст и накладные расходы сводятся к одному вызову
+    def __init__(self):
+        self.exporters: list[Exporter] = []
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.exporters)
+
+    def timer(self, name: str, **labels) -> typing.ContextManager:
+        if not self.exporters:
+            return _NULL_TIMER
+        return _Timer(self.exporters, name, labels)
+
+    def count(self, name: str, value: float = 1, **labels):
+        if not self.exporters:
+            return
+        for exporter in self.exporters:
+            exporter.increment(name, labels, value)
+
+
+class _Timer:
+    __slots__ = ('exporters', 'name', 'labels', 'spans', 'started_at')
+
+    def __init__(self, exporters: list[Exporter], name: str, labels: dict):
+        self.exporters = exporters
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.spans = contextlib.ExitStack()
+        for exporter in self.exporters:
+            span = exporter.span(self.name, self.labels)
+            if span is not None:
+                self.spans.enter_context(span)
+        self.started_at = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        seconds = time.perf_counter() - self.started_at
+        for exporter in self.exporters:
+            exporter.observe(self.name, self.labels, seconds, exc_type is not None)
+        return self.spans.__exit__(exc_type, exc_value, traceback)
+
+
+_NULL_TIMER = contextlib.nullcontext()
+
+metrics = Metrics()
+
+
+def enable(*exporters: Exporter):
+    metrics.exporters.extend(exporters)
+
+
+def disable():
+    metrics.exporters.clear()
+
+
+def timed(name: str, **labels):
+    # Декоратор для async-методов QdClient: метка collection берётся из аргумента collection_name
+    def decorator(func):
+        signature = inspect.signature(func)
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            if not metrics.exporters:
+                return await func(*args, **kwargs)
+            collection = signature.bind_partial(*args, **kwargs).arguments.get('collection_name')
+            with metrics.timer(name, collection=collection, **labels):
+                return await func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def label_key(labels: dict) -> tuple:
+    return tuple(sorted((key, str(value)) for key, value in labels.items() if value is not None))
+
+
+class InMemoryRecorder(Exporter):
+    # Все замеры в памяти процесса - для тестов и бенчмарков
+    def __init__(self):
+        self.durations: list[tuple[str, dict, float, bool]] = []
+        self.counters: dict[tuple[str, tuple], float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, labels: dict, seconds: float, error: bool):
+        with self._lock:
+            self.durations.append((name, dict(labels), seconds, error))
+
+    def increment(self, name: str, labels: dict, value: float):
+        key = (name, label_key(labels))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def summary(self) -> dict:
+        grouped: dict[str, list[float]] = {}
+        errors: dict[str, int] = {}
+        for name, _, seconds, error in self.durations:
+            grouped.setdefault(name, []).append(seconds)
+            errors[name] = errors.get(name, 0) + error
+        result = {}
+        for name, values in grouped.items():
+            values.sort()
+            result[name] = {
+                'count': len(values),
+                'errors': errors[name],
+                'total_seconds': sum(values),
+                'p50_seconds': values[len(values) // 2],
+                'p95_seconds': values[min(len(values) - 1, int(len(values) * 0.95))],
+            }
+        return result
+
+    def clear(self):
+        with self._lock:
+            self.durations.clear()
+            self.counters.clear()
+
+
+class PrometheusExporter(Exporter):
+    # Агрегирует гистограммы и счётчики, render() отдаёт текстовый формат Prometheus
+    # (для HTTP-обработчика /metrics или textfile collector node_exporter)
+    buckets = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.)
+
+    def __init__(self, prefix: str = "qdclient", buckets: typing.Sequence[float] | None = None):
+        self.prefix = prefix
+        if buckets is not None:
+            self.buckets = tuple(sorted(buckets))
+        self._histograms: dict[tuple[str, tuple], list] = {}
+        self._counters: dict[tuple[str, tuple], float] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, name: str, labels: dict, seconds: float, error: bool):
+        key = (name, label_key({**labels, 'status': 'error' if error else 'ok'}))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.buckets), 0., 0]
+            index = bisect.bisect_left(self.buckets, seconds)
+            if index < len(self.buckets):
+                histogram[0][index] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def increment(self, name: str, labels: dict, value: float):
+        key = (name, label_key(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    @staticmethod
+    def _labels(labels: tuple, le: str | None = None) -> str:
+        if le is not None:
+            labels = (*labels, ('le', le))
+        parts = []
+        for key, value in labels:
+            value = value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+            parts.append(f'{key}="{value}"')
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+
+        typed = set()
+        for (name, labels), (bucket_counts, total, count) in histograms:
+            metric = f"{self.prefix}_{name}_seconds"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} histogram")
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                cumulative += bucket_count
+                lines.append(f"{metric}_bucket{self._labels(labels, str(bound))} {cumulative}")
+            lines.append(f"{metric}_bucket{self._labels(labels, '+Inf')} {count}")
+            lines.append(f"{metric}_sum{self._labels(labels)} {total}")
+            lines.append(f"{metric}_count{self._labels(labels)} {count}")
+
+        for (name, labels), value in counters:
+            metric = f"{self.prefix}_{name}_total"
+            if metric not in typed:
+                typed.add(metric)
+                lines.append(f"# TYPE {metric} counter")
+            lines.append(f"{metric}{self._labels(labels)} {value}")
+
+        return "\n".join(lines) + "\n"
+
+
+class OpenTelemetryExporter(Exporter):
+    # Каждая операция - span OpenTelemetry с метками в атрибутах; вложенные вызовы
+    # (эмбеддинг внутри hybrid_search) становятся дочерними span. opentelemetry-api -
+    # необязательная зависимость, импортируется только при создании экспортера
+    def __init__(self, tracer=None, prefix: str = "qdclient"):
+        if tracer is None:
+            from opentelemetry import trace
+            tracer = trace.get_tracer(prefix)
+        self.tracer = tracer
+        self.prefix = prefix
+
+    def span(self, name: str, labels: dict) -> typing.ContextManager:
+        attributes = {f"{self.prefix}.{key}": str(value) for key, value in labels.items() if value is not None}
+        return self.tracer.start_as_current_span(f"{self.prefix}.{name}", attributes=attributes)
+
+
+def result_size(result: typing.Any) -> int | None:
+    # Сколько points вернул Qdrant: по этому числу видно объём передаваемого payload
+    if hasattr(result, 'points'):
+        return len(result.points)
+    if isinstance(result, tuple) and result and isinstance(result[0], list):
+        return len(result[0])
+    if isinstance(result, list):
+        if all(hasattr(item, 'points') for item in result):
+            return sum(len(item.points) for item in result)
+        if all(hasattr(item, 'payload') for item in result):
+            return len(result)
+    return None
+
+
+class InstrumentedQdrant:
+    # Прокси над AsyncQdrantClient: каждый асинхронный метод замеряется как qdrant_request
+    # с метками method и collection. При выключенных метриках методы отдаются как есть
+    def __init__(self, qdrant):
+        self.qdrant = qdrant
+
+    def __getattr__(self, name: str):
+        attribute = getattr(self.qdrant, name)
+        if not metrics.enabled or not asyncio.iscoroutinefunction(attribute):
+            return attribute
+
+        async def instrumented(*args, **kwargs):
+            collection = kwargs.get('collection_name', args[0] if args and isinstance(args[0], str) else None)
+            with metrics.timer('qdrant_request', method=name, collection=collection):
+                result = await attribute(*args, **kwargs)
+            size = result_size(result)
+            if size is not None:
+                metrics.count('qdrant_points_returned', size, method=name, collection=collection)
+            return result
+
+        return instrumented
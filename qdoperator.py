@@ -1,16 +1,26 @@
 import asyncio
+import contextlib
 import datetime
 
 import qdrant_client
 import qdrant_client.models
 import qdrant_client.conversions
 import enum
+import hashlib
+import json
 import logging
+import time
 import typing
 import uuid
 
 
+import qdcache
+import qdchunker
+import qddedup
+import qdmetrics
 import qdparser
+import qdscheduler
+import qdsparse
 
 
 class TypeOfSource(enum.Enum):
@@ -22,11 +32,81 @@ class TypeOfSource(enum.Enum):
     WORD_FILE = "Word файл"
 
 
+POINT_ID_NAMESPACE = uuid.UUID("6f1f7c52-3c1e-4d2a-9f57-0b8f3f1f4a10")
+
+FUSION_WEIGHTED = "weighted"
+FUSION_MODES = {
+    "rrf": qdrant_client.models.Fusion.RRF,
+    "dbsf": qdrant_client.models.Fusion.DBSF,
+    FUSION_WEIGHTED: None,
+}
+
+# Готовые настройки квантизации для VectorInfo(quantization=...): исходные векторы остаются
+# для rescore, в RAM держатся только квантизированные
+QUANTIZATION_MODES = {
+    "scalar": qdrant_client.models.ScalarQuantization(
+        scalar=qdrant_client.models.ScalarQuantizationConfig(
+            type=qdrant_client.models.ScalarType.INT8, quantile=0.99, always_ram=True)),
+    "product": qdrant_client.models.ProductQuantization(
+        product=qdrant_client.models.ProductQuantizationConfig(
+            compression=qdrant_client.models.CompressionRatio.X16, always_ram=True)),
+    "binary": qdrant_client.models.BinaryQuantization(
+        binary=qdrant_client.models.BinaryQuantizationConfig(always_ram=True)),
+}
+
+HASH_FIELDS = ['payload_hash', 'embed_hash']
+# Служебное поле payload, которое не строится из DataObject: источники почти дубликатов (qddedup)
+MERGED_SOURCES_FIELD = 'merged_sources'
+CHANGE_PAYLOAD = "payload"
+CHANGE_VECTORS = "vectors"
+
+
+def content_hash(value: typing.Any) -> str:
+    data = json.dumps(value, sort_keys=True, ensure_ascii=False, separators=(',', ':'), default=str)
+    return hashlib.blake2b(data.encode('utf-8'), digest_size=16).hexdigest()
+
+
+@contextlib.asynccontextmanager
+async def task_group() -> typing.AsyncIterator[asyncio.TaskGroup]:
+    # asyncio.TaskGroup, но ошибка задачи поднимается как есть, а не внутри ExceptionGroup:
+    # обработчики вызывающего кода (openai.RateLimitError, UnexpectedResponse) продолжают срабатывать
+    try:
+        async with asyncio.TaskGroup() as group:
+            yield group
+    except BaseExceptionGroup as error:
+        while isinstance(error, BaseExceptionGroup):
+            error = error.exceptions[0]
+        raise error from None
+
+
+async def iter_chunks(items: typing.Iterable | typing.AsyncIterable, size: int) -> typing.AsyncIterator[list]:
+    chunk = []
+    if isinstance(items, typing.AsyncIterable):
+        async for item in items:
+            chunk.append(item)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+    else:
+        for item in items:
+            chunk.append(item)
+            if len(chunk) >= size:
+                yield chunk
+                chunk = []
+
+    if chunk:
+        yield chunk
+
+
 class DataObject:
     type_source: TypeOfSource
     source: str
     tokens: list
 
+    # Поля естественного ключа: из них детерминированно строится id point (см. make_point_id).
+    # Без аннотации, чтобы не попасть в get_fields
+    natural_key = ()
+
     def __init__(self, type_source: TypeOfSource, source: str, tokens: list = None):
         self.type_source = type_source
         self.source = source
@@ -45,6 +125,23 @@ class DataObject:
     def get_fields(cls):
         return list(cls.__annotations__.keys())
 
+    @classmethod
+    def make_point_id(cls, values: typing.Union[typing.Mapping, "DataObject"]) -> str | None:
+        if not cls.natural_key:
+            return None
+
+        parts = [cls.__name__]
+        for field in cls.natural_key:
+            try:
+                value = values[field]
+            except KeyError:
+                return None
+            if value is None:
+                return None
+            parts.append(str(value))
+
+        return str(uuid.uuid5(POINT_ID_NAMESPACE, "\x1f".join(parts)))
+
     def __iter__(self) -> typing.Iterator[tuple[str, any]]:
         yield 'type_source', self.type_source.value
         yield 'source', self.source
@@ -69,6 +166,8 @@ class NomenclatureObjet(DataObject):
     n_id: str
     modified_at: float | None
 
+    natural_key = ('n_id',)
+
     def __init__(self, content: str, type_source: TypeOfSource, source: str, n_id: str, modified_at: str | None):
         super().__init__(type_source, source)
         self.content = content
@@ -120,13 +219,17 @@ class RedmineWikiObject(DataObject):
     project: str
     name: str
 
+    natural_key = ('source', 'chunk_index')
+
     def __init__(self, content: str, type_source: TypeOfSource, source: str,
-                 title: str, project: str, name: str, tokens: list = None):
+                 title: str, project: str, name: str, tokens: list = None, chunk_index: int | None = None):
         super().__init__(type_source, source, tokens)
         self.content = content
         self.title = title
         self.project = project
         self.name = name
+        # Порядковый номер чанка в файле, необязательный для старых выгрузок
+        self.chunk_index = chunk_index
 
     @classmethod
     def from_dict(cls, item: dict):
@@ -139,7 +242,8 @@ class RedmineWikiObject(DataObject):
             title=str(item['title']),
             project=str(item['project']),
             name=str(item['name']),
-            tokens=item.get('tokens', None))
+            tokens=item.get('tokens', None),
+            chunk_index=item.get('chunk_index', None))
 
     def __iter__(self) -> typing.Iterator[tuple[str, any]]:
         yield 'content', self.content
@@ -149,6 +253,7 @@ class RedmineWikiObject(DataObject):
         yield 'title', self.title
         yield 'project', self.project
         yield 'name', self.name
+        yield 'chunk_index', self.chunk_index
 
     def __getitem__(self, key: str) -> typing.Any:
         if key == 'content':
@@ -163,6 +268,8 @@ class RedmineWikiObject(DataObject):
             return self.project
         elif key == 'name':
             return self.name
+        elif key == 'chunk_index':
+            return self.chunk_index
         elif key == 'tokens':
             return self.tokens
         else:
@@ -187,6 +294,8 @@ class UcCourseScheduleObject(DataObject):
     schedule_price: list
     schedule_order_url: str | bool
 
+    natural_key = ('schedule_id',)
+
     def __init__(
             self,
             type_source: TypeOfSource,
@@ -306,6 +415,8 @@ class UcQuestion(DataObject):
     question: str
     answer: str
 
+    natural_key = ('source', 'question')
+
     def __init__(
             self,
             type_source: TypeOfSource,
@@ -358,6 +469,8 @@ class AlexQuestion(DataObject):
     question: str
     answer: str
 
+    natural_key = ('source',)
+
     def __init__(
             self,
             type_source: TypeOfSource,
@@ -519,6 +632,8 @@ class UcCourseObject(DataObject):
     course_formats: list | None
     course_url: str | None
 
+    natural_key = ('course_id',)
+
     def __init__(
             self,
             type_source: TypeOfSource,
@@ -647,7 +762,18 @@ class VectorInfo:
     distance: qdrant_client.models.Distance
 
     def __init__(self, name: str, size: int, name_for_embed: str, client_embed, type_of_object: typing.Type[DataObject],
-                 distance: qdrant_client.models.Distance = qdrant_client.models.Distance.COSINE):
+                 distance: qdrant_client.models.Distance = qdrant_client.models.Distance.COSINE,
+                 model: str = "text-embedding-3-small", batch_size: int = 256, batch_tokens: int = 100_000,
+                 scheduler: qdscheduler.EmbeddingScheduler | None = None,
+                 cache: qdcache.EmbeddingCache | None = None,
+                 quantization: str | qdrant_client.models.QuantizationConfig | None = None,
+                 on_disk: bool | None = None, hnsw_config: qdrant_client.models.HnswConfigDiff | None = None,
+                 datatype: qdrant_client.models.Datatype | None = None):
+        if isinstance(quantization, str):
+            if quantization not in QUANTIZATION_MODES:
+                raise ValueError(f"Некорректный тип квантизации: {quantization}. "
+                                 f"Допустимые значения: {', '.join(QUANTIZATION_MODES)}")
+            quantization = QUANTIZATION_MODES[quantization]
         if not any(key == name_for_embed for key in type_of_object.get_fields()):
             raise ValueError(f"Вы должны указать для какого поля будет происходить векторизация: "
                              f"{', '.join(type_of_object.get_fields())}")
@@ -657,16 +783,98 @@ class VectorInfo:
         self.size = size
         self.distance = distance
         self.client = client_embed
+        self.model = model
+        self.batch_size = batch_size
+        self.batch_tokens = batch_tokens
+        # Один планировщик можно передать нескольким VectorInfo, чтобы они делили квоту провайдера
+        self.scheduler = scheduler or qdscheduler.EmbeddingScheduler()
+        self.cache = cache
+        # Параметры хранения вектора в Qdrant, None - настройки коллекции по умолчанию
+        self.quantization = quantization
+        self.on_disk = on_disk
+        self.hnsw_config = hnsw_config
+        self.datatype = datatype
+
+    def vector_params(self) -> qdrant_client.models.VectorParams:
+        return qdrant_client.models.VectorParams(
+            size=self.size, distance=self.distance, quantization_config=self.quantization,
+            on_disk=self.on_disk, hnsw_config=self.hnsw_config, datatype=self.datatype)
 
-    async def get_embedding(self, text: str, model: str = "text-embedding-3-small") -> list[float]:
-        if text is None:
-            return [0.] * self.size
+    async def get_embedding(self, text: str, model: str = None) -> list[float]:
+        embeddings = await self.get_embeddings([text], model)
+        return embeddings[0]
+
+    async def get_embeddings(self, texts: list[str | None], model: str = None) -> list[list[float]]:
+        model = model or self.model
+        embeddings: list[list[float] | None] = [None] * len(texts)
+
+        # Пустые значения не отправляем в модель, для них сразу нулевой вектор
+        pending = []
+        for index, text in enumerate(texts):
+            if text is None:
+                embeddings[index] = [0.] * self.size
+            else:
+                pending.append(index)
+
+        cache_keys = {}
+        if self.cache is not None and pending:
+            cache_keys = {index: self.cache.make_key(self.name, model, self.size, texts[index]) for index in pending}
+            cached = await asyncio.to_thread(self.cache.get_many, list(cache_keys.values()))
+            for index in pending:
+                embeddings[index] = cached.get(cache_keys[index])
+            pending = [index for index in pending if embeddings[index] is None]
+            qdmetrics.metrics.count('embedding_cache_hits', len(cache_keys) - len(pending), vector=self.name)
+
+        pending_texts = [texts[index] for index in pending]
+        qdmetrics.metrics.count('embedding_texts', len(pending_texts), vector=self.name)
+        batches = list(self.split_batches(pending_texts))
+        results = await asyncio.gather(*(
+            self._run_batch([pending_texts[i] for i in batch], model, batch_tokens)
+            for batch, batch_tokens in batches))
+
+        for (batch, _), batch_embeddings in zip(batches, results):
+            for i, embedding in zip(batch, batch_embeddings):
+                embeddings[pending[i]] = embedding
+
+        if cache_keys and pending:
+            await asyncio.to_thread(
+                self.cache.set_many, {cache_keys[index]: embeddings[index] for index in pending})
+
+        return embeddings
+
+    async def _run_batch(self, texts: list[str], model: str, tokens: int) -> list[list[float]]:
+        return await self.scheduler.run(self._timed_embed_batch, texts, model, tokens=tokens)
+
+    async def _timed_embed_batch(self, texts: list[str], model: str) -> list[list[float]]:
+        with qdmetrics.metrics.timer('embedding_request', vector=self.name):
+            return await self._embed_batch(texts, model)
+
+    def split_batches(self, texts: list[str]) -> typing.Iterator[tuple[list[int], int]]:
+        batch = []
+        batch_tokens = 0
+        for index, text in enumerate(texts):
+            tokens = self.estimate_tokens(text)
+            if batch and (len(batch) >= self.batch_size or batch_tokens + tokens > self.batch_tokens):
+                yield batch, batch_tokens
+                batch = []
+                batch_tokens = 0
+            batch.append(index)
+            batch_tokens += tokens
+
+        if batch:
+            yield batch, batch_tokens
+
+    @staticmethod
+    def estimate_tokens(text: str) -> int:
+        # Та же оценка, что и при нарезке чанков: бюджет батча и размер чанка не должны расходиться
+        return qdchunker.estimate_tokens(text)
 
+    async def _embed_batch(self, texts: list[str], model: str) -> list[list[float]]:
         response = await self.client.embeddings.create(
-            input=text,
+            input=texts,
             model=model
         )
-        return response.data[0].embedding
+        return [item.embedding for item in sorted(response.data, key=lambda item: item.index)]
 
     async def get_size(self) -> int:
         vector = await self.get_embedding('test')
@@ -676,49 +884,116 @@ class VectorInfo:
 class VectorInfoOllama(VectorInfo):
     def __init__(self, name: str, size: int, name_for_embed: str, client_embed,
                  type_of_object: typing.Type[DataObject],
-                 distance: qdrant_client.models.Distance = qdrant_client.models.Distance.COSINE):
-        super().__init__(name, size, name_for_embed, client_embed, type_of_object, distance)
-
-    async def get_embedding(self, text: str, model: str = None) -> list[float]:
-        response = self.client.get_text_embedding(text)
-        return response
+                 distance: qdrant_client.models.Distance = qdrant_client.models.Distance.COSINE,
+                 batch_size: int = 256, batch_tokens: int = 100_000,
+                 scheduler: qdscheduler.EmbeddingScheduler | None = None,
+                 cache: qdcache.EmbeddingCache | None = None,
+                 quantization: str | qdrant_client.models.QuantizationConfig | None = None,
+                 on_disk: bool | None = None, hnsw_config: qdrant_client.models.HnswConfigDiff | None = None,
+                 datatype: qdrant_client.models.Datatype | None = None,
+                 max_concurrency: int = 2, model: str | None = None):
+        # Один сервер Ollama плохо переносит много параллельных запросов: без своего планировщика
+        # одновременно выполняется не больше max_concurrency батчей.
+        # model входит в ключ кэша эмбеддингов и в embed_hash: смена модели под тем же именем вектора
+        # не отдаст старые векторы из кэша и приведёт к пересчёту. По умолчанию - model_name клиента
+        super().__init__(name, size, name_for_embed, client_embed, type_of_object, distance,
+                         model=model or getattr(client_embed, 'model_name', None),
+                         batch_size=batch_size, batch_tokens=batch_tokens,
+                         scheduler=scheduler or qdscheduler.EmbeddingScheduler(max_concurrency=max_concurrency),
+                         cache=cache, quantization=quantization, on_disk=on_disk, hnsw_config=hnsw_config, datatype=datatype)
+
+    async def _embed_batch(self, texts: list[str], model: str) -> list[list[float]]:
+        # Асинхронный батч-метод клиента (OllamaEmbedding из llama_index) не блокирует цикл событий,
+        # синхронные методы выполняются в пуле потоков
+        if hasattr(self.client, 'aget_text_embedding_batch'):
+            return await self.client.aget_text_embedding_batch(texts)
+        if hasattr(self.client, 'get_text_embedding_batch'):
+            return await asyncio.to_thread(self.client.get_text_embedding_batch, texts)
+        return await asyncio.to_thread(lambda: [self.client.get_text_embedding(text) for text in texts])
 
 
 class VectorInfoSelf(VectorInfo):
     def __init__(self, name: str, size: int, name_for_embed: str, client_embed,
-                 type_of_object: typing.Type[DataObject]):
-        super().__init__(name, size, name_for_embed, client_embed, type_of_object)
+                 type_of_object: typing.Type[DataObject],
+                 batch_size: int = 256, batch_tokens: int = 100_000,
+                 scheduler: qdscheduler.EmbeddingScheduler | None = None,
+                 cache: qdcache.EmbeddingCache | None = None,
+                 quantization: str | qdrant_client.models.QuantizationConfig | None = None,
+                 on_disk: bool | None = None, hnsw_config: qdrant_client.models.HnswConfigDiff | None = None,
+                 datatype: qdrant_client.models.Datatype | None = None,
+                 max_wait: float | None = 0.005, model: str | None = None):
+        # model - идентификатор локальной модели для кэша и embed_hash, по умолчанию берётся из клиента
+        super().__init__(name, size, name_for_embed, client_embed, type_of_object,
+                         model=model or self.client_model_name(client_embed),
+                         batch_size=batch_size, batch_tokens=batch_tokens, scheduler=scheduler,
+                         cache=cache, quantization=quantization, on_disk=on_disk, hnsw_config=hnsw_config, datatype=datatype)
+        # Одновременные вызовы (поиск из разных корутин) склеиваются в один encode до batch_size текстов:
+        # max_wait - сколько секунд ждать попутчиков, None - каждый вызов кодируется отдельно
+        self.batcher = None
+        if max_wait is not None:
+            self.batcher = qdscheduler.MicroBatcher(self._encode_merged, batch_size, max_wait)
 
-    async def get_embedding(self, text: str | list[str], model: str = None) -> list[float]:
-        single_input = False
+    @staticmethod
+    def client_model_name(client_embed) -> str | None:
+        # SentenceTransformer хранит имя базовой модели в model_card_data, путь загрузки - у токенайзера
+        base_model = getattr(getattr(client_embed, 'model_card_data', None), 'base_model', None)
+        if base_model:
+            return base_model
+        return getattr(getattr(client_embed, 'tokenizer', None), 'name_or_path', None) or None
+
+    async def get_embedding(self, text: str | list[str], model: str = None) -> list[float] | list[list[float]]:
         if isinstance(text, str):
-            text = [text]
-            single_input = True
+            return await super().get_embedding(text, model)
+        return await self.get_embeddings(text, model)
 
-        embeddings = await asyncio.to_thread(self.client.encode, text)
-        embeddings = embeddings.tolist()
+    async def _run_batch(self, texts: list[str], model: str, tokens: int) -> list[list[float]]:
+        if self.batcher is None:
+            return await super()._run_batch(texts, model, tokens)
+        return await self.batcher.submit(texts)
 
-        if single_input:
-            return embeddings[0]
-        else:
-            return embeddings
+    async def _encode_merged(self, texts: list[str]) -> list[list[float]]:
+        tokens = sum(self.estimate_tokens(text) for text in texts)
+        return await super()._run_batch(texts, self.model, tokens)
+
+    async def _embed_batch(self, texts: list[str], model: str) -> list[list[float]]:
+        embeddings = await asyncio.to_thread(self.client.encode, texts)
+        return embeddings.tolist()
 
 
 class QdClient:
-    def __init__(self, gd_host: str, qd_port: int, qd_key: str):
-        self.qdrant = qdrant_client.AsyncQdrantClient(
-            url=f"http://{gd_host}:{qd_port}",
-            api_key=qd_key)
+    def __init__(self, gd_host: str | None = None, qd_port: int | None = None, qd_key: str | None = None,
+                 query_cache: qdcache.QueryEmbeddingCache | None = None,
+                 query_tokenizer: qdparser.QueryTokenizer | None = None,
+                 location: str | None = None):
+        # location=":memory:" - локальный режим qdrant_client без сервера (тесты, бенчмарки)
+        if location is not None:
+            qdrant = qdrant_client.AsyncQdrantClient(location=location)
+        else:
+            qdrant = qdrant_client.AsyncQdrantClient(
+                url=f"http://{gd_host}:{qd_port}",
+                api_key=qd_key)
+        # Обращения к Qdrant замеряются, когда подключены экспортеры qdmetrics
+        self.qdrant = qdmetrics.InstrumentedQdrant(qdrant)
         self.collection_configs = {}
+        self.query_cache = query_cache or qdcache.QueryEmbeddingCache()
+        self.query_tokenizer = query_tokenizer or qdparser.QueryTokenizer()
 
     async def create_collection(self, collection_name: str, vector_config: list,
                                 type_of_object: typing.Type[DataObject],
-                                payload_index: list | None = None):
+                                payload_index: list | None = None,
+                                natural_ids: bool = False,
+                                sparse_vector: qdsparse.SparseVectorInfo | None = None,
+                                on_disk_payload: bool | None = None,
+                                hnsw_config: qdrant_client.models.HnswConfigDiff | None = None):
+        if natural_ids and not type_of_object.natural_key:
+            raise ValueError(f"Для {type_of_object.__name__} не объявлен natural_key.")
 
         self.collection_configs[collection_name] = {
             "vector_config": vector_config,
             "type_of_object": type_of_object,
-            "payload_index": payload_index
+            "payload_index": payload_index,
+            "natural_ids": natural_ids,
+            "sparse_vector": sparse_vector
         }
 
         response = await self.qdrant.get_collections()
@@ -726,17 +1001,21 @@ class QdClient:
 
         if collection_name in existing_collections:
             logging.warning(f"Коллекция '{collection_name}' уже существует.")
+            if sparse_vector is not None:
+                await self.enable_sparse_idf(collection_name, sparse_vector)
         else:
-            vectors_config = {
-                vector.name: qdrant_client.models.VectorParams(
-                    size=vector.size, distance=vector.distance
-                )
-                for vector in vector_config
-            }
+            vectors_config = {vector.name: vector.vector_params() for vector in vector_config}
+
+            sparse_vectors_config = None
+            if sparse_vector is not None:
+                sparse_vectors_config = {sparse_vector.name: sparse_vector.vector_params()}
 
             await self.qdrant.create_collection(
                 collection_name=collection_name,
-                vectors_config=vectors_config)
+                vectors_config=vectors_config,
+                sparse_vectors_config=sparse_vectors_config,
+                on_disk_payload=on_disk_payload,
+                hnsw_config=hnsw_config)
 
             if payload_index:
                 for index in payload_index:
@@ -747,6 +1026,20 @@ class QdClient:
 
             logging.info(f"Коллекция '{collection_name}' успешно создана.")
 
+    async def enable_sparse_idf(self, collection_name: str, sparse_vector: qdsparse.SparseVectorInfo):
+        # Добавить разреженный вектор в существующую коллекцию Qdrant не позволяет, можно только
+        # включить модификатор IDF у уже объявленного (коллекции, созданные до перехода на Modifier.IDF)
+        collection = await self.qdrant.get_collection(collection_name)
+        sparse_vectors = collection.config.params.sparse_vectors or {}
+        params = sparse_vectors.get(sparse_vector.name)
+        if params is None:
+            raise ValueError(f"В коллекции '{collection_name}' нет разреженного вектора '{sparse_vector.name}'. "
+                             f"Чтобы подключить лексический канал, коллекцию нужно пересоздать.")
+        if params.modifier != qdrant_client.models.Modifier.IDF:
+            await self.qdrant.update_collection(
+                collection_name=collection_name,
+                sparse_vectors_config={sparse_vector.name: sparse_vector.vector_params()})
+
     async def delete_by_filter(self, filter_data: dict, collection_name: str):
         filtering = []
         for key, value in filter_data.items():
@@ -766,28 +1059,94 @@ class QdClient:
     async def delete_collection(self, collection_name: str):
         await self.qdrant.delete_collection(collection_name)
 
-    async def search(self, text: str, collection_name: str, using: str, limit: int = 3):
+    @qdmetrics.timed('search', method='search')
+    async def search(self, text: str, collection_name: str, using: str, limit: int = 3,
+                     hnsw_ef: int | None = None, exact: bool = False,
+                     oversampling: float | None = None, rescore: bool | None = None):
+        vector = self.find_vector(collection_name, using)
+        text_vector = await self.embed_query(vector, text)
+        res = await self.qdrant.query_points(
+            collection_name=collection_name,
+            query=text_vector,
+            using=vector.name,
+            limit=limit,
+            search_params=self.search_params(hnsw_ef, exact, oversampling, rescore))
+
+        return res.points
+
+    @qdmetrics.timed('search', method='search_many')
+    async def search_many(self, texts: list[str], collection_name: str, using: str, limit: int = 3,
+                          hnsw_ef: int | None = None, exact: bool = False,
+                          oversampling: float | None = None, rescore: bool | None = None,
+                          batch_size: int = 256) -> list[list[qdrant_client.models.ScoredPoint]]:
+        # Пакетный аналог search: эмбеддинги всех запросов считаются батчами, поиск - через
+        # query_batch_points; результаты в порядке texts
+        vector = self.find_vector(collection_name, using)
+        embeddings = await self.embed_queries(vector, texts)
+        params = self.search_params(hnsw_ef, exact, oversampling, rescore)
+        requests = [
+            qdrant_client.models.QueryRequest(
+                query=embedding, using=vector.name, limit=limit, params=params, with_payload=True)
+            for embedding in embeddings
+        ]
+        responses = await self.query_batch(collection_name, requests, batch_size)
+        return [response.points for response in responses]
+
+    def find_vector(self, collection_name: str, field: str) -> VectorInfo:
         config = self.collection_configs.get(collection_name)
         if config is None:
             raise ValueError(f"Конфигурация для коллекции '{collection_name}' не найдена.")
-        vector_config = config["vector_config"]
 
-        for vector in vector_config:
-            if vector.name_for_embed == using:
-                text_vector = await vector.get_embedding(text.lower())
-                res = await self.qdrant.query_points(
-                    collection_name=collection_name,
-                    query=text_vector,
-                    using=vector.name,
-                    limit=limit)
-                break
-        else:
-            raise ValueError(f"Некорректное название для векторизуемого поля - {using}")
+        for vector in config["vector_config"]:
+            if vector.name_for_embed == field:
+                return vector
+        raise ValueError(f"Некорректное название для векторизуемого поля - {field}")
 
-        return res.points
+    async def query_batch(self, collection_name: str, requests: list[qdrant_client.models.QueryRequest],
+                          batch_size: int = 256) -> list[qdrant_client.models.QueryResponse]:
+        responses = []
+        for i in range(0, len(requests), batch_size):
+            responses.extend(await self.qdrant.query_batch_points(
+                collection_name=collection_name, requests=requests[i: i + batch_size]))
+        return responses
 
+    @qdmetrics.timed('search', method='hybrid_search')
     async def hybrid_search(self, text: str, collection_name: str,
-                            field_vectors: list, limit: int = 3):
+                            field_vectors: list, limit: int = 3, fusion: str | None = None,
+                            prefetch_limit: int | dict[str, int] | None = None,
+                            weights: dict[str, float] | None = None,
+                            hnsw_ef: int | None = None, exact: bool = False,
+                            oversampling: float | None = None, rescore: bool | None = None,
+                            token_filter: bool = True):
+        results = await self._hybrid_search_many(
+            [text], collection_name, field_vectors, limit=limit, fusion=fusion, prefetch_limit=prefetch_limit,
+            weights=weights, hnsw_ef=hnsw_ef, exact=exact, oversampling=oversampling, rescore=rescore,
+            token_filter=token_filter)
+        return results[0]
+
+    @qdmetrics.timed('search', method='hybrid_search_many')
+    async def hybrid_search_many(self, texts: list[str], collection_name: str,
+                                 field_vectors: list, limit: int = 3, fusion: str | None = None,
+                                 prefetch_limit: int | dict[str, int] | None = None,
+                                 weights: dict[str, float] | None = None,
+                                 hnsw_ef: int | None = None, exact: bool = False,
+                                 oversampling: float | None = None, rescore: bool | None = None,
+                                 batch_size: int = 256,
+                                 token_filter: bool = True) -> list[list[qdrant_client.models.ScoredPoint]]:
+        return await self._hybrid_search_many(
+            texts, collection_name, field_vectors, limit=limit, fusion=fusion, prefetch_limit=prefetch_limit,
+            weights=weights, hnsw_ef=hnsw_ef, exact=exact, oversampling=oversampling, rescore=rescore,
+            batch_size=batch_size, token_filter=token_filter)
+
+    async def _hybrid_search_many(self, texts: list[str], collection_name: str,
+                                  field_vectors: list, limit: int = 3, fusion: str | None = None,
+                                  prefetch_limit: int | dict[str, int] | None = None,
+                                  weights: dict[str, float] | None = None,
+                                  hnsw_ef: int | None = None, exact: bool = False,
+                                  oversampling: float | None = None, rescore: bool | None = None,
+                                  batch_size: int = 256,
+                                  token_filter: bool = True) -> list[list[qdrant_client.models.ScoredPoint]]:
+        # Общая часть hybrid_search и hybrid_search_many: метрика 'search' пишется только в публичных методах
         config = self.collection_configs.get(collection_name)
         if config is None:
             raise ValueError(f"Конфигурация для коллекции '{collection_name}' не найдена.")
@@ -796,64 +1155,151 @@ class QdClient:
 
         if not field_vectors:
             raise ValueError("Список field_vectors не должен быть пустым")
+        if fusion is not None and fusion not in FUSION_MODES:
+            raise ValueError(f"Некорректный способ объединения результатов: {fusion}. "
+                             f"Допустимые значения: {', '.join(FUSION_MODES)}")
 
-        text_lower = text.lower()
-        main_vector = None
-        main_vector_name = None
-        prefetch_objects = []
+        # Глубина каждой ветки prefetch задаётся отдельно от итогового limit: число или словарь по веткам
+        def branch_limit(branch: str) -> int:
+            if isinstance(prefetch_limit, dict):
+                return prefetch_limit.get(branch, limit)
+            return prefetch_limit or limit
+
+        fields = [(field, self.find_vector(collection_name, field)) for field in field_vectors]
+
+        # Векторы одного типа считают эмбеддинг запроса одинаково, тогда он считается один раз
         same_vectors = len(set(type(v) for v in vector_config)) == 1
-        embedding = await vector_config[0].get_embedding(text_lower)
-
-        for field in field_vectors:
-            vector_found = None
-            for vector in vector_config:
-                if vector.name_for_embed == field:
-                    vector_found = vector
-                    break
-            if vector_found is None:
-                raise ValueError(f"Некорректное название для векторизуемого поля: {field}")
-
-            if not same_vectors:
-                embedding = await vector_found.get_embedding(text_lower)
-
-            if main_vector is None:
-                main_vector = embedding
-                main_vector_name = vector_found.name
-
-            prefetch_objects.append(
-                qdrant_client.models.Prefetch(
+        embed_vectors = [vector_config[0]] if same_vectors else list({v.name: v for _, v in fields}.values())
+        embedded = await asyncio.gather(*(self.embed_queries(vector, texts) for vector in embed_vectors))
+        embeddings = dict(zip((vector.name for vector in embed_vectors), embedded))
+
+        params = self.search_params(hnsw_ef, exact, oversampling, rescore)
+        sparse_vector = config.get("sparse_vector")
+        queries = []
+        requests = []
+        for index, text in enumerate(texts):
+            branches = []
+            for field, vector in fields:
+                embedding = embeddings[vector_config[0].name if same_vectors else vector.name][index]
+                branches.append((field, qdrant_client.models.Prefetch(
                     query=embedding,
-                    using=vector_found.name,
-                    limit=limit))
-
-        if payload_index:
-            query_tokens = qdparser.FileParser().tokenize_text(text)
-            filtering_conditions = []
-            for token in query_tokens:
-                filtering_conditions.append(
-                    qdrant_client.models.FieldCondition(
-                        key="tokens",
-                        match=qdrant_client.models.MatchValue(value=token)))
-            token_filter = qdrant_client.models.Filter(should=filtering_conditions)
-
-            res = await self.qdrant.query_points(
-                collection_name=collection_name,
-                prefetch=prefetch_objects,
-                query=main_vector,
-                using=main_vector_name,
-                limit=limit,
-                query_filter=token_filter)
-        else:
-            res = await self.qdrant.query_points(
-                collection_name=collection_name,
-                prefetch=prefetch_objects,
-                query=main_vector,
-                using=main_vector_name,
-                limit=limit)
+                    using=vector.name,
+                    limit=branch_limit(field),
+                    params=params)))
+            main_vector = branches[0][1].query
+            main_vector_name = branches[0][1].using
+
+            if sparse_vector is not None:
+                sparse_query = sparse_vector.encode_query(text)
+                if sparse_query is not None:
+                    branches.append((sparse_vector.name, qdrant_client.models.Prefetch(
+                        query=sparse_query,
+                        using=sparse_vector.name,
+                        limit=branch_limit(sparse_vector.name))))
+
+            query_filter = None
+            if payload_index and token_filter:
+                query_tokens = self.query_tokenizer.tokenize(text)
+                filtering_conditions = []
+                for token in query_tokens:
+                    filtering_conditions.append(
+                        qdrant_client.models.FieldCondition(
+                            key="tokens",
+                            match=qdrant_client.models.MatchValue(value=token)))
+                query_filter = qdrant_client.models.Filter(should=filtering_conditions)
+
+            if fusion is None:
+                queries.append((branches, len(requests), 1))
+                requests.append(qdrant_client.models.QueryRequest(
+                    prefetch=[prefetch for _, prefetch in branches],
+                    query=main_vector,
+                    using=main_vector_name,
+                    filter=query_filter,
+                    params=params,
+                    limit=limit,
+                    with_payload=True))
+                continue
+
+            # При объединении результатов фильтр по токенам применяется внутри каждой ветки
+            if query_filter is not None:
+                for _, prefetch in branches:
+                    prefetch.filter = query_filter
+
+            if fusion == FUSION_WEIGHTED:
+                # Каждая ветка - отдельный запрос в общем батче, объединение локальное
+                queries.append((branches, len(requests), len(branches)))
+                requests.extend(
+                    qdrant_client.models.QueryRequest(
+                        query=prefetch.query,
+                        using=prefetch.using,
+                        filter=prefetch.filter,
+                        params=prefetch.params,
+                        limit=prefetch.limit,
+                        with_payload=True)
+                    for _, prefetch in branches)
+            else:
+                queries.append((branches, len(requests), 1))
+                requests.append(qdrant_client.models.QueryRequest(
+                    prefetch=[prefetch for _, prefetch in branches],
+                    query=qdrant_client.models.FusionQuery(fusion=FUSION_MODES[fusion]),
+                    limit=limit,
+                    with_payload=True))
+
+        responses = await self.query_batch(collection_name, requests, batch_size)
+        if fusion != FUSION_WEIGHTED:
+            return [responses[start].points for _, start, _ in queries]
+        return [
+            self.weighted_fusion(branches, responses[start: start + count], limit, weights or {})
+            for branches, start, count in queries
+        ]
 
-        return res.points
+    @staticmethod
+    def weighted_fusion(branches: list[tuple[str, qdrant_client.models.Prefetch]],
+                        responses: list[qdrant_client.models.QueryResponse],
+                        limit: int, weights: dict[str, float]) -> list[qdrant_client.models.ScoredPoint]:
+        # Оценки веток несравнимы между собой, поэтому перед взвешиванием нормируем их в [0, 1]
+        scores = {}
+        points = {}
+        for (branch, _), response in zip(branches, responses):
+            if not response.points:
+                continue
+            low = min(point.score for point in response.points)
+            high = max(point.score for point in response.points)
+            for point in response.points:
+                normalized = (point.score - low) / (high - low) if high > low else 1.
+                scores[point.id] = scores.get(point.id, 0.) + weights.get(branch, 1.) * normalized
+                points.setdefault(point.id, point)
+
+        ranked = sorted(scores, key=scores.get, reverse=True)[:limit]
+        return [points[point_id].model_copy(update={'score': scores[point_id]}) for point_id in ranked]
 
-    async def must_search(self, filter_data: dict, collection_name: str):
+    @staticmethod
+    def search_params(hnsw_ef: int | None = None, exact: bool = False, oversampling: float | None = None,
+                      rescore: bool | None = None) -> qdrant_client.models.SearchParams | None:
+        # oversampling/rescore действуют только для коллекций с квантизацией
+        if hnsw_ef is None and not exact and oversampling is None and rescore is None:
+            return None
+
+        quantization = None
+        if oversampling is not None or rescore is not None:
+            quantization = qdrant_client.models.QuantizationSearchParams(oversampling=oversampling, rescore=rescore)
+        return qdrant_client.models.SearchParams(hnsw_ef=hnsw_ef, exact=exact, quantization=quantization)
+
+    async def embed_query(self, vector: VectorInfo, text: str) -> list[float]:
+        text_lower = text.lower()
+        with qdmetrics.metrics.timer('query_embedding', vector=vector.name):
+            return await self.query_cache.get_or_compute(
+                (vector.name, text_lower), lambda: vector.get_embedding(text_lower))
+
+    async def embed_queries(self, vector: VectorInfo, texts: list[str]) -> list[list[float]]:
+        # Все отсутствующие в кэше запросы векторизуются одним вызовом get_embeddings (внутри - батчами)
+        keys = [(vector.name, text.lower()) for text in texts]
+        with qdmetrics.metrics.timer('query_embedding', vector=vector.name):
+            return await self.query_cache.get_or_compute_many(
+                keys, lambda missing: vector.get_embeddings([text for _, text in missing]))
+
+    @staticmethod
+    def build_must_filter(filter_data: dict) -> qdrant_client.models.Filter:
         filtering = []
         for key, value in filter_data.items():
             if isinstance(value, dict) and '$in' in value:
@@ -869,7 +1315,10 @@ class QdClient:
                     match=qdrant_client.models.MatchValue(value=value)
                 ))
 
-        filter_search = qdrant_client.models.Filter(must=filtering)
+        return qdrant_client.models.Filter(must=filtering)
+
+    async def must_search(self, filter_data: dict, collection_name: str):
+        filter_search = self.build_must_filter(filter_data)
 
         response = await self.qdrant.scroll(
             collection_name=collection_name,
@@ -889,7 +1338,54 @@ class QdClient:
 
         return response[0]
 
-    async def add_points(self, points_batch: list[dict], collection_name: str):
+    async def iter_points(self, collection_name: str, scroll_filter: qdrant_client.models.Filter | None = None,
+                          page_size: int = 256, with_payload: bool | list[str] = True,
+                          with_vectors: bool | list[str] = False,
+                          prefetch: bool = False) -> typing.AsyncIterator[qdrant_client.models.Record]:
+        async def fetch(offset):
+            return await self.qdrant.scroll(
+                collection_name=collection_name,
+                scroll_filter=scroll_filter,
+                limit=page_size,
+                offset=offset,
+                with_payload=with_payload,
+                with_vectors=with_vectors)
+
+        next_page = None
+        try:
+            records, offset = await fetch(None)
+            while True:
+                # С prefetch следующая страница запрашивается, пока вызывающий код обрабатывает текущую
+                if prefetch and offset is not None:
+                    next_page = asyncio.ensure_future(fetch(offset))
+
+                for record in records:
+                    yield record
+
+                if offset is None:
+                    return
+                if next_page is not None:
+                    records, offset = await next_page
+                    next_page = None
+                else:
+                    records, offset = await fetch(offset)
+        finally:
+            if next_page is not None:
+                next_page.cancel()
+
+    def iter_all(self, collection_name: str, **kwargs) -> typing.AsyncIterator[qdrant_client.models.Record]:
+        return self.iter_points(collection_name=collection_name, **kwargs)
+
+    def iter_must_search(self, filter_data: dict, collection_name: str,
+                         **kwargs) -> typing.AsyncIterator[qdrant_client.models.Record]:
+        return self.iter_points(
+            collection_name=collection_name, scroll_filter=self.build_must_filter(filter_data), **kwargs)
+
+    @qdmetrics.timed('write', method='add_points')
+    async def add_points(self, points_batch: list[dict | DataObject], collection_name: str,
+                         batch_size: int = 100, upsert_parallel: int = 4,
+                         deduplicator: qddedup.NearDuplicateFilter | None = None,
+                         flush_vocabulary: bool = True) -> dict:
         config = self.collection_configs.get(collection_name)
         if config is None:
             raise ValueError(f"Конфигурация для коллекции '{collection_name}' не найдена.")
@@ -898,221 +1394,548 @@ class QdClient:
 
         correct_data_object = []
         for point in points_batch:
-            correct_data_object.append(type_of_object.from_dict(point))
-
-        correct_points = []
-        embedding_cache = {}
-        for index, point in enumerate(correct_data_object, 1):
-            vector_data = {}
-            for vector in vector_config:
-                text_to_embed = point[vector.name_for_embed]
-                cache_key = f"{vector.name}:{text_to_embed}"
-
-                if cache_key in embedding_cache:
-                    embed_result = embedding_cache[cache_key]
+            if isinstance(point, DataObject):
+                correct_data_object.append(point)
+            else:
+                correct_data_object.append(type_of_object.from_dict(point))
+
+        point_ids = [self.new_point_id(config, point) for point in correct_data_object]
+        duplicates = 0
+        if deduplicator is not None:
+            # Почти дубликаты не векторизуются и не записываются
+            embed_fields = [vector.name_for_embed for vector in vector_config]
+            kept = [
+                (point_id, point) for point_id, point in zip(point_ids, correct_data_object)
+                if deduplicator.check(point_id, deduplicator.text_of(point, embed_fields),
+                                      getattr(point, 'source', None) or point_id) is None
+            ]
+            duplicates = len(correct_data_object) - len(kept)
+            point_ids = [point_id for point_id, _ in kept]
+            correct_data_object = [point for _, point in kept]
+
+        batches = [list(zip(point_ids[i: i + batch_size], correct_data_object[i: i + batch_size]))
+                   for i in range(0, len(correct_data_object), batch_size)]
+        timings = {'embedding': 0., 'upsert': 0.}
+        upsert_slots = asyncio.Semaphore(upsert_parallel)
+        started_at = time.perf_counter()
+
+        async def embed(batch: list[tuple[str, DataObject]]) -> list[qdrant_client.models.PointStruct]:
+            stage_started_at = time.perf_counter()
+            vectors = await self.embed_objects(vector_config, [point for _, point in batch],
+                                               config.get("sparse_vector"))
+            timings['embedding'] += time.perf_counter() - stage_started_at
+            # С естественными id upsert может перезаписать существующий point - его merged_sources сохраняем
+            merged_sources = {}
+            if config.get("natural_ids"):
+                merged_sources = await self.load_merged_sources(collection_name, [point_id for point_id, _ in batch])
+            return [
+                self.create_point(doc_id=point_id, vector=vector_data, data_object=point,
+                                  vector_config=self.embedded_vectors(config),
+                                  merged_sources=merged_sources.get(str(point_id)))
+                for (point_id, point), vector_data in zip(batch, vectors)
+            ]
+
+        async def upsert(chunk: list[qdrant_client.models.PointStruct], wait: bool):
+            stage_started_at = time.perf_counter()
+            try:
+                await self.qdrant.upsert(collection_name=collection_name, points=chunk, wait=wait)
+            finally:
+                upsert_slots.release()
+            timings['upsert'] += time.perf_counter() - stage_started_at
+
+        # Пока батч N отправляется в Qdrant, батч N+1 уже векторизуется
+        last_chunk = []
+        if batches:
+            async with task_group() as group:
+                next_embedding = group.create_task(embed(batches[0]))
+                for index in range(len(batches)):
+                    chunk = await next_embedding
+                    if index + 1 == len(batches):
+                        last_chunk = chunk
+                        break
+                    next_embedding = group.create_task(embed(batches[index + 1]))
+                    await upsert_slots.acquire()
+                    group.create_task(upsert(chunk, wait=False))
+
+            # Барьер: Qdrant применяет обновления по порядку, поэтому после ответа на последний upsert
+            # с wait=True все предыдущие, отправленные с wait=False, тоже применены
+            await upsert_slots.acquire()
+            await upsert(last_chunk, wait=True)
+
+        if deduplicator is not None and deduplicator.mode == qddedup.MODE_LINK:
+            # Дописываем источники только к уже записанным каноническим points: канонический point
+            # из параллельного вызова add_points получит их в конце своего вызова
+            deduplicator.confirm(point_ids)
+            await self.link_duplicates(collection_name, deduplicator.take_dirty())
+        if flush_vocabulary:
+            await self.save_vocabulary(config.get("sparse_vector"), force=True)
+
+        qdmetrics.metrics.count('points_written', len(correct_data_object), collection=collection_name,
+                                change=CHANGE_VECTORS)
+        qdmetrics.metrics.count('duplicates_skipped', duplicates, collection=collection_name)
+        stats = {
+            'points': len(correct_data_object),
+            'duplicates': duplicates,
+            'embedding_seconds': timings['embedding'],
+            'upsert_seconds': timings['upsert'],
+            'total_seconds': time.perf_counter() - started_at,
+        }
+        logging.info(f"Успешно записано {stats['points']} чанков в коллекцию '{collection_name}' "
+                     f"за {stats['total_seconds']:.2f} с (эмбеддинги {stats['embedding_seconds']:.2f} с, "
+                     f"upsert {stats['upsert_seconds']:.2f} с, пропущено почти дубликатов {duplicates}).")
+        return stats
+
+    async def link_duplicates(self, collection_name: str, merged_sources: dict[str, list[str]],
+                              batch_size: int = 100):
+        # Канонический point мог быть записан в одном из прошлых батчей, поэтому список
+        # объединённых источников дописывается отдельной операцией после upsert. Источники,
+        # сохранённые прошлыми загрузками, не теряются
+        stored = await self.load_merged_sources(collection_name, list(merged_sources))
+        operations = [
+            qdrant_client.models.SetPayloadOperation(
+                set_payload=qdrant_client.models.SetPayload(
+                    payload={MERGED_SOURCES_FIELD: list(dict.fromkeys([*stored.get(str(point_id), []), *sources]))},
+                    points=[point_id]))
+            for point_id, sources in merged_sources.items()
+        ]
+        for i in range(0, len(operations), batch_size):
+            await self.qdrant.batch_update_points(
+                collection_name=collection_name, update_operations=operations[i: i + batch_size], wait=True)
+
+    async def load_merged_sources(self, collection_name: str, ids: list[str]) -> dict[str, list[str]]:
+        if not ids:
+            return {}
+        records = await self.qdrant.retrieve(
+            collection_name=collection_name,
+            ids=ids,
+            with_payload=[MERGED_SOURCES_FIELD],
+            with_vectors=False)
+        return {str(record.id): record.payload[MERGED_SOURCES_FIELD]
+                for record in records if record.payload.get(MERGED_SOURCES_FIELD)}
+
+    @qdmetrics.timed('write', method='update_points')
+    async def update_points(self, points_batch: list[dict], collection_name: str,
+                            compare_fields: list[str], fields_to_check: list[str], batch_size: int = 256):
+        config = self.collection_configs.get(collection_name)
+        if config is None:
+            raise ValueError(f"Конфигурация для коллекции '{collection_name}' не найдена.")
+        type_of_object = config["type_of_object"]
+
+        updated = 0
+        adding = 0
+        # Для сравнения достаточно ключа и хэшей, поля fields_to_check догружаются только для старых points
+        payload_fields = list(dict.fromkeys([*compare_fields, *HASH_FIELDS, MERGED_SOURCES_FIELD]))
+        for i in range(0, len(points_batch), batch_size):
+            data_objects = [type_of_object.from_dict(record) for record in points_batch[i: i + batch_size]]
+            # Существующие points для всего батча ищем одним запросом, сравниваем уже локально
+            if config.get("natural_ids"):
+                keys = [type_of_object.make_point_id(point_data) for point_data in data_objects]
+                existing_points = await self.retrieve_existing(collection_name, keys, payload_fields)
+            else:
+                keys = [self.compare_key(point_data, compare_fields) for point_data in data_objects]
+                existing_points = await self.find_existing(collection_name, keys, payload_fields)
+            await self.load_unhashed_fields(collection_name, list(existing_points.values()), fields_to_check)
+
+            writes = []
+            merged_sources = {}
+            pending_ids = {}
+            for point_data, key in zip(data_objects, keys):
+                existing_point = existing_points.get(key)
+                change = CHANGE_VECTORS
+                if existing_point:
+                    change = self.detect_change(existing_point.payload, point_data, config, fields_to_check)
+                    if change is None:
+                        continue
+
+                if existing_point:
+                    point_id = getattr(existing_point, "id", None) or existing_point.get("id")
+                    if point_id is None:
+                        point_id = str(uuid.uuid4())
+                        adding += 1
+                    else:
+                        updated += 1
+                elif key and key in pending_ids:
+                    # Запись с тем же ключом уже ждёт записи в этом батче - обновляем её, а не дублируем
+                    point_id = pending_ids[key]
+                    updated += 1
                 else:
-                    embed_result = await vector.get_embedding(text_to_embed)
-                    embedding_cache[cache_key] = embed_result
+                    point_id = self.new_point_id(config, point_data)
+                    adding += 1
 
-                vector_data[vector.name] = embed_result
+                if key:
+                    pending_ids[key] = point_id
+                if existing_point and existing_point.payload.get(MERGED_SOURCES_FIELD):
+                    merged_sources[point_id] = existing_point.payload[MERGED_SOURCES_FIELD]
+                writes.append((point_id, point_data, change))
 
-            correct_points.append(self.create_point(
-                doc_id=str(uuid.uuid4()),
-                vector=vector_data,
-                data_object=point))
+            await self.write_points(collection_name, config, writes, merged_sources)
 
-        for i in range(0, len(correct_points), 100):
-            chunk = correct_points[i: i + 100]
+        await self.save_vocabulary(config.get("sparse_vector"), force=True)
+        return {'updating': updated, 'adding': adding}
+
+    async def write_points(self, collection_name: str, config: dict, writes: list[tuple[str, DataObject, str]],
+                           merged_sources: dict[str, list[str]] | None = None):
+        # merged_sources - сохранённые источники почти дубликатов по id: полный upsert иначе удалил бы их
+        hashed_vectors = self.embedded_vectors(config)
+        vector_writes = [(point_id, point_data) for point_id, point_data, change in writes if change == CHANGE_VECTORS]
+        payload_writes = [(point_id, point_data) for point_id, point_data, change in writes if change == CHANGE_PAYLOAD]
+        qdmetrics.metrics.count('points_written', len(vector_writes), collection=collection_name, change=CHANGE_VECTORS)
+        qdmetrics.metrics.count('points_written', len(payload_writes), collection=collection_name, change=CHANGE_PAYLOAD)
+
+        vectors = await self.embed_objects(
+            config["vector_config"], [point_data for _, point_data in vector_writes], config.get("sparse_vector"))
+        merged_sources = merged_sources or {}
+        upsert_points = [
+            self.create_point(doc_id=point_id, vector=vector_data, data_object=point_data, vector_config=hashed_vectors,
+                              merged_sources=merged_sources.get(point_id))
+            for (point_id, point_data), vector_data in zip(vector_writes, vectors)
+        ]
+        for i in range(0, len(upsert_points), 100):
             await self.qdrant.upsert(
                 collection_name=collection_name,
-                points=chunk)
+                points=upsert_points[i: i + 100]
+            )
+
+        # Тексты для векторов не изменились - обновляем только payload, без эмбеддингов. Набор полей
+        # DataObject постоянен, поэтому SetPayload заменяет их все и не трогает служебные merged_sources
+        operations = [
+            qdrant_client.models.SetPayloadOperation(
+                set_payload=qdrant_client.models.SetPayload(
+                    payload=self.hashed_payload(point_data, hashed_vectors),
+                    points=[point_id]))
+            for point_id, point_data in payload_writes
+        ]
+        for i in range(0, len(operations), 100):
+            await self.qdrant.batch_update_points(
+                collection_name=collection_name,
+                update_operations=operations[i: i + 100])
+
+    def detect_change(self, payload: dict, point_data: DataObject, config: dict,
+                      fields_to_check: list[str]) -> str | None:
+        if payload.get('payload_hash') is None:
+            # Point записан до появления хэшей - сравниваем поля по-старому
+            if self.payload_matches(payload, point_data, fields_to_check):
+                return None
+            return CHANGE_VECTORS
+
+        new_payload = self.hashed_payload(point_data, self.embedded_vectors(config))
+        if new_payload['payload_hash'] == payload['payload_hash']:
+            return None
+        if new_payload['embed_hash'] == payload.get('embed_hash'):
+            return CHANGE_PAYLOAD
+        return CHANGE_VECTORS
+
+    async def load_unhashed_fields(self, collection_name: str, records: list[qdrant_client.models.Record],
+                                   fields: list[str]):
+        unhashed = [record for record in records if record.payload.get('payload_hash') is None]
+        if not unhashed or not fields:
+            return
 
-        logging.info(f"Успешно записано {len(correct_points)} чанков в коллекцию '{collection_name}'.")
+        full_records = await self.qdrant.retrieve(
+            collection_name=collection_name,
+            ids=[record.id for record in unhashed],
+            with_payload=fields,
+            with_vectors=False)
+        payloads = {str(record.id): record.payload for record in full_records}
+        for record in unhashed:
+            record.payload.update(payloads.get(str(record.id), {}))
 
-    async def update_points(self, points_batch: list[dict], collection_name: str,
-                            compare_fields: list[str], fields_to_check: list[str]):
+    @staticmethod
+    def new_point_id(config: dict, point_data: DataObject) -> str:
+        if config.get("natural_ids"):
+            point_id = config["type_of_object"].make_point_id(point_data)
+            if point_id is not None:
+                return point_id
+        return str(uuid.uuid4())
+
+    async def retrieve_existing(self, collection_name: str, ids: list[str | None],
+                                payload_fields: list[str] | None = None) -> dict[str, qdrant_client.models.Record]:
+        wanted = list(dict.fromkeys(point_id for point_id in ids if point_id))
+        if not wanted:
+            return {}
+
+        records = await self.qdrant.retrieve(
+            collection_name=collection_name,
+            ids=wanted,
+            with_payload=payload_fields if payload_fields else True,
+            with_vectors=False)
+        return {str(record.id): record for record in records}
+
+    async def rekey_collection(self, collection_name: str, batch_size: int = 256) -> int:
         config = self.collection_configs.get(collection_name)
         if config is None:
             raise ValueError(f"Конфигурация для коллекции '{collection_name}' не найдена.")
-        vector_config = config["vector_config"]
         type_of_object = config["type_of_object"]
+        if not type_of_object.natural_key:
+            raise ValueError(f"Для {type_of_object.__name__} не объявлен natural_key.")
+
+        rekeyed = 0
+        missing_key = 0
+        offset = None
+        while True:
+            records, offset = await self.qdrant.scroll(
+                collection_name=collection_name,
+                limit=batch_size,
+                offset=offset,
+                with_payload=True,
+                with_vectors=True)
+
+            moved_points = []
+            old_ids = []
+            for record in records:
+                point_id = type_of_object.make_point_id(record.payload)
+                if point_id is None:
+                    missing_key += 1
+                    continue
+                if point_id == str(record.id):
+                    continue
+                moved_points.append(qdrant_client.models.PointStruct(
+                    id=point_id, vector=record.vector, payload=record.payload))
+                old_ids.append(record.id)
 
-        updated = 0
-        adding = 0
-        for record in points_batch:
-            point_data = type_of_object.from_dict(record)
-
-            filter_data = {}
-            for field in compare_fields:
-                if field in point_data.get_fields():
-                    filter_data[field] = point_data[field]
-
-            existing_point = None
-            if filter_data:
-                filtering = []
-                for key, value in filter_data.items():
-                    filtering.append(
-                        qdrant_client.models.FieldCondition(
-                            key=key,
-                            match=qdrant_client.models.MatchValue(value=value)
-                        )
-                    )
-
-                filter_search = qdrant_client.models.Filter(must=filtering)
-
-                # Выполняем поиск через scroll с ограничением до одного найденного элемента
-                response = await self.qdrant.scroll(
-                    collection_name=collection_name,
-                    scroll_filter=filter_search,
-                    limit=1
-                )
-                if response[0] and len(response[0]) > 0:
-                    existing_point = response[0][0]
-
-            if existing_point:
-                all_match = True
-                for field in fields_to_check:
-                    if field in point_data.get_fields():
-                        value = point_data[field]
-                        if isinstance(value, datetime.date) and not isinstance(value, datetime.time):
-                            value = value.strftime("%Y-%m-%d")
-                        elif isinstance(value, datetime.time):
-                            value = value.strftime("%H:%M:%S")
-                    else:
-                        value = None
+            # Дубликаты с одинаковым естественным ключом схлопываются в один point
+            if moved_points:
+                await self.qdrant.upsert(collection_name=collection_name, points=moved_points)
+                await self.delete_by_ids(old_ids, collection_name)
+                rekeyed += len(moved_points)
 
-                    left_value = getattr(existing_point.payload, field, None)
-                    if left_value is None and hasattr(existing_point.payload, 'get'):
-                        left_value = existing_point.payload.get(field)
+            if offset is None:
+                break
 
-                    if left_value != value:
-                        all_match = False
-                        break
+        logging.info(f"В коллекции '{collection_name}' переназначены id у {rekeyed} points.")
+        if missing_key:
+            # Для таких points нельзя вычислить id: с natural_ids следующая загрузка продублировала бы их
+            logging.warning(f"У {missing_key} points коллекции '{collection_name}' в payload нет полей "
+                            f"{', '.join(type_of_object.natural_key)}, natural_ids не включены. "
+                            f"Перезагрузите эти записи и повторите rekey_collection.")
+            return rekeyed
 
-                if all_match:
-                    continue
+        config["natural_ids"] = True
+        return rekeyed
 
-            vectors = {}
-            vector_cache = {}
-            for vector in vector_config:
-                text = point_data[vector.name_for_embed]
-                cache_key = (vector.name, text)
-                if cache_key in vector_cache:
-                    embedding = vector_cache[cache_key]
-                else:
-                    embedding = await vector.get_embedding(text)
-                    vector_cache[cache_key] = embedding
-                vectors[vector.name] = embedding
+    @staticmethod
+    def compare_key(point_data: DataObject, compare_fields: list[str]) -> tuple:
+        # Поля берутся через __getitem__: не все поля объекта аннотированы (chunk_index у RedmineWikiObject)
+        key = []
+        for field in compare_fields:
+            try:
+                key.append((field, point_data[field]))
+            except KeyError:
+                raise ValueError(f"Поле сравнения '{field}' отсутствует в {type(point_data).__name__}") from None
+        return tuple(key)
+
+    async def find_existing(self, collection_name: str, keys: list[tuple],
+                            payload_fields: list[str] | None = None) -> dict[tuple, qdrant_client.models.Record]:
+        wanted = set(key for key in keys if key)
+        if not wanted:
+            return {}
+
+        # MatchAny по каждому полю даёт надмножество нужных points, точное совпадение ключа проверяем ниже.
+        # Значению None соответствуют points, в payload которых поля нет (старые выгрузки)
+        fields = [field for field, _ in next(iter(wanted))]
+        conditions = []
+        for index, field in enumerate(fields):
+            values = {key[index][1] for key in wanted}
+            present = [value for value in values if value is not None]
+            field_conditions = []
+            if present:
+                field_conditions.append(qdrant_client.models.FieldCondition(
+                    key=field,
+                    match=qdrant_client.models.MatchAny(any=present)))
+            if len(present) < len(values):
+                field_conditions.append(qdrant_client.models.IsEmptyCondition(
+                    is_empty=qdrant_client.models.PayloadField(key=field)))
+            conditions.append(qdrant_client.models.Filter(should=field_conditions))
+        filter_search = qdrant_client.models.Filter(must=conditions)
+
+        found = {}
+        offset = None
+        while True:
+            records, offset = await self.qdrant.scroll(
+                collection_name=collection_name,
+                scroll_filter=filter_search,
+                limit=max(len(wanted), 100),
+                offset=offset,
+                with_payload=payload_fields if payload_fields else True,
+                with_vectors=False)
+
+            for record in records:
+                key = tuple((field, record.payload.get(field)) for field in fields)
+                if key in wanted and key not in found:
+                    found[key] = record
+
+            if offset is None or len(found) == len(wanted):
+                break
 
-            if existing_point:
-                point_id = getattr(existing_point, "id", None) or existing_point.get("id")
-                if point_id is None:
-                    point_id = str(uuid.uuid4())
-                    adding += 1
-                else:
-                    updated += 1
+        return found
+
+    @staticmethod
+    def payload_matches(payload: dict, point_data: DataObject, fields_to_check: list[str]) -> bool:
+        for field in fields_to_check:
+            if field in point_data.get_fields():
+                value = point_data[field]
+                if isinstance(value, datetime.date) and not isinstance(value, datetime.time):
+                    value = value.strftime("%Y-%m-%d")
+                elif isinstance(value, datetime.time):
+                    value = value.strftime("%H:%M:%S")
             else:
-                point_id = str(uuid.uuid4())
-                adding += 1
+                value = None
 
-            upsert_point = self.create_point(
-                doc_id=point_id,
-                vector=vectors,
-                data_object=point_data
-            )
+            left_value = getattr(payload, field, None)
+            if left_value is None and hasattr(payload, 'get'):
+                left_value = payload.get(field)
 
-            await self.qdrant.upsert(
-                collection_name=collection_name,
-                points=[upsert_point]
-            )
+            if left_value != value:
+                return False
 
-        return {'updating': updated, 'adding': adding}
+        return True
 
-    async def update_points_for_date(self, points_batch: list[dict], collection_name: str, compare_field: str):
+    @qdmetrics.timed('write', method='update_points_for_date')
+    async def update_points_for_date(self, points_batch: typing.Iterable[dict] | typing.AsyncIterable[dict],
+                                     collection_name: str, compare_field: str,
+                                     batch_size: int = 256, cursor: float | None = None) -> dict:
         config = self.collection_configs.get(collection_name)
         if config is None:
             raise ValueError(f"Конфигурация для коллекции '{collection_name}' не найдена.")
-        vector_config = config["vector_config"]
         type_of_object = config["type_of_object"]
 
-        records, next_offset = await self.qdrant.scroll(
-            collection_name=collection_name,
-            limit=1,
-            order_by=qdrant_client.models.OrderBy(key=compare_field, direction=qdrant_client.models.Direction.DESC),
-            with_payload=True,
-            with_vectors=False)
-
-        if records:
-            timestamp_in_db = records[0].payload.get(compare_field)
-            if timestamp_in_db is not None:
-                max_db_date = datetime.datetime.fromtimestamp(float(timestamp_in_db))
+        # cursor - UNIX-время последней синхронизированной записи, без него берём максимум из коллекции
+        if cursor is None:
+            records, next_offset = await self.qdrant.scroll(
+                collection_name=collection_name,
+                limit=1,
+                order_by=qdrant_client.models.OrderBy(key=compare_field, direction=qdrant_client.models.Direction.DESC),
+                with_payload=[compare_field],
+                with_vectors=False)
+
+            if records:
+                cursor = records[0].payload.get(compare_field)
+                if cursor is None:
+                    raise ValueError(f"Поле {compare_field} не является UNIX представлением даты")
             else:
-                raise ValueError(f"Поле {compare_field} не является UNIX представлением даты")
-        else:
-            raise ValueError("В коллекции отсутствуют points")
+                raise ValueError("В коллекции отсутствуют points")
 
-        max_batch_date = None
-        for record in points_batch:
-            if dt_str := record.get(compare_field):
-                dt_val = datetime.datetime.fromisoformat(dt_str)
-                if (max_batch_date is None) or (dt_val > max_batch_date):
-                    max_batch_date = dt_val
+        max_db_date = datetime.datetime.fromtimestamp(float(cursor))
+        max_synced_date = max_db_date
+        payload_fields = [compare_field, 'n_id', *HASH_FIELDS, MERGED_SOURCES_FIELD]
+        updated = 0
+        adding = 0
+        async for chunk in iter_chunks(points_batch, batch_size):
+            # Из нескольких версий одной записи в батче оставляем самую свежую
+            fresh_records = {}
+            for index, record in enumerate(chunk):
+                if dt_str := record.get(compare_field):
+                    dt_val = datetime.datetime.fromisoformat(dt_str)
+                    if dt_val <= max_db_date:
+                        continue
+                    record_key = ('n_id', n_id) if (n_id := record.get("n_id")) else ('index', index)
+                    if record_key not in fresh_records or dt_val > fresh_records[record_key][0]:
+                        fresh_records[record_key] = (dt_val, record)
+
+            if not fresh_records:
+                continue
+
+            dates = [dt_val for dt_val, _ in fresh_records.values()]
+            data_objects = [type_of_object.from_dict(record) for _, record in fresh_records.values()]
+            if config.get("natural_ids"):
+                keys = [type_of_object.make_point_id(point_data) for point_data in data_objects]
+                existing_points = await self.retrieve_existing(collection_name, keys, payload_fields)
+            else:
+                keys = [self.compare_key(point_data, ['n_id']) for point_data in data_objects]
+                existing_points = await self.find_existing(collection_name, keys, payload_fields)
+
+            writes = []
+            merged_sources = {}
+            for dt_val, point_data, key in zip(dates, data_objects, keys):
+                max_synced_date = max(max_synced_date, dt_val)
+                existing_record = existing_points.get(key)
+                if existing_record:
+                    old_timestamp = existing_record.payload.get(compare_field)
+                    if old_timestamp is not None and dt_val <= datetime.datetime.fromtimestamp(float(old_timestamp)):
+                        continue
+                    # Более свежая дата уже означает изменение записи: у points, записанных до появления
+                    # хэшей, сравнивать нечего, их векторы пересчитываются
+                    change = CHANGE_VECTORS
+                    if existing_record.payload.get('payload_hash') is not None:
+                        change = self.detect_change(existing_record.payload, point_data, config, [])
+                        if change is None:
+                            continue
+                    if existing_record.payload.get(MERGED_SOURCES_FIELD):
+                        merged_sources[existing_record.id] = existing_record.payload[MERGED_SOURCES_FIELD]
+                    writes.append((existing_record.id, point_data, change))
+                    updated += 1
+                else:
+                    writes.append((self.new_point_id(config, point_data), point_data, CHANGE_VECTORS))
+                    adding += 1
 
-        if max_db_date and max_batch_date <= max_db_date:
-            return
+            await self.write_points(collection_name, config, writes, merged_sources)
 
-        points_for_upsert = []
-        for record in points_batch:
-            if dt_str := record.get(compare_field):
-                dt_val = datetime.datetime.fromisoformat(dt_str)
-                if (not max_db_date) or (dt_val > max_db_date):
-                    if n_id := record.get("n_id"):
-                        filter_ = qdrant_client.models.Filter(
-                            must=[
-                                qdrant_client.models.FieldCondition(
-                                    key="n_id",
-                                    match=qdrant_client.models.MatchValue(value=n_id))])
-
-                        found_records, _offset = await self.qdrant.scroll(
-                            collection_name=collection_name,
-                            scroll_filter=filter_,
-                            limit=1,
-                            with_payload=True,
-                            with_vectors=False)
-
-                        if found_records:
-                            existing_record = found_records[0]
-                            old_timestamp = existing_record.payload.get(compare_field)
-                            if old_timestamp is not None:
-                                old_dt = datetime.datetime.fromtimestamp(float(old_timestamp))
-                                if dt_val <= old_dt:
-                                    continue
-                            qdrant_id = existing_record.id
-                        else:
-                            qdrant_id = str(uuid.uuid4())
-                    else:
-                        qdrant_id = str(uuid.uuid4())
-
-                    point_data = type_of_object.from_dict(record)
-                    vectors = {
-                        vector.name: await vector.get_embedding(point_data[vector.name_for_embed])
-                        for vector in vector_config
-                    }
-                    upsert_point = self.create_point(
-                        doc_id=qdrant_id,
-                        vector=vectors,
-                        data_object=point_data
-                    )
-                    points_for_upsert.append(upsert_point)
-
-        if points_for_upsert:
-            await self.qdrant.upsert(
-                collection_name=collection_name,
-                points=points_for_upsert)
-            logging.info(f"Обновлено/добавлено {len(points_for_upsert)} записей в коллекции '{collection_name}'.")
+        await self.save_vocabulary(config.get("sparse_vector"), force=True)
+        if updated or adding:
+            logging.info(f"Обновлено {updated}, добавлено {adding} записей в коллекции '{collection_name}'.")
         else:
             logging.info("Не нашлось записей для обновления/добавления.")
 
+        return {'updating': updated, 'adding': adding, 'cursor': max_synced_date.timestamp()}
+
     @staticmethod
-    def create_point(doc_id: str | int, vector: list | dict[str, list], data_object: DataObject):
-        return qdrant_client.models.PointStruct(id=doc_id, vector=vector, payload=dict(data_object))
+    async def embed_objects(vector_config: list, data_objects: list[DataObject],
+                            sparse_vector: qdsparse.SparseVectorInfo | None = None) -> list[dict]:
+        texts_by_vector = [
+            [data_object[vector.name_for_embed] for data_object in data_objects]
+            for vector in vector_config
+        ]
+        # Одинаковые тексты векторизуем один раз, результат раскладываем по индексам points
+        unique_by_vector = [list(dict.fromkeys(texts)) for texts in texts_by_vector]
+        results = await asyncio.gather(*(
+            vector.get_embeddings(unique_texts)
+            for vector, unique_texts in zip(vector_config, unique_by_vector)))
+
+        vectors = [{} for _ in data_objects]
+        for vector, texts, unique_texts, embeddings in zip(vector_config, texts_by_vector, unique_by_vector, results):
+            embeddings = dict(zip(unique_texts, embeddings))
+            for vector_data, text in zip(vectors, texts):
+                vector_data[vector.name] = embeddings[text]
+
+        if sparse_vector is not None:
+            texts = [data_object[sparse_vector.name_for_embed] for data_object in data_objects]
+            sparse_vector.fit(texts)
+            for vector_data, text in zip(vectors, texts):
+                sparse_embedding = sparse_vector.encode_document(text)
+                if sparse_embedding is not None:
+                    vector_data[sparse_vector.name] = sparse_embedding
+            await QdClient.save_vocabulary(sparse_vector)
+
+        return vectors
+
+    @staticmethod
+    async def save_vocabulary(sparse_vector: qdsparse.SparseVectorInfo | None, force: bool = False):
+        # Между батчами словарь сохраняется не чаще save_interval, в конце операции записи - всегда
+        if sparse_vector is not None and sparse_vector.needs_save(force):
+            await asyncio.to_thread(sparse_vector.save, sparse_vector.snapshot())
+
+    @staticmethod
+    def embedded_vectors(config: dict) -> list:
+        if config.get("sparse_vector") is None:
+            return config["vector_config"]
+        return [*config["vector_config"], config["sparse_vector"]]
+
+    @staticmethod
+    def hashed_payload(data_object: DataObject, vector_config: list | None = None) -> dict:
+        payload = dict(data_object)
+        payload['payload_hash'] = content_hash(payload)
+        if vector_config is not None:
+            # В хэш векторизуемых полей входят имя вектора и модель: смена модели тоже требует пересчёта
+            payload['embed_hash'] = content_hash({
+                vector.name: [vector.model, data_object[vector.name_for_embed]]
+                for vector in vector_config
+            })
+        return payload
+
+    @classmethod
+    def create_point(cls, doc_id: str | int, vector: list | dict[str, list], data_object: DataObject,
+                     vector_config: list | None = None, merged_sources: list[str] | None = None):
+        payload = cls.hashed_payload(data_object, vector_config)
+        if merged_sources:
+            payload[MERGED_SOURCES_FIELD] = merged_sources
+        return qdrant_client.models.PointStruct(id=doc_id, vector=vector, payload=payload)
@@ -1,163 +1,227 @@
+import asyncio
+import collections
+import concurrent.futures
+import functools
 import logging
 import os
 import re
+import typing
 import yake
-import bs4
+
+import qdchunker
+import qdhtml
+import qdmetrics
+
+
+def build_keyword_extractor() -> yake.KeywordExtractor:
+    return yake.KeywordExtractor(
+        lan="ru", n=3, dedupLim=0.5, dedupFunc='seqm', windowsSize=1, top=20, features=None)
+
+
+class QueryTokenizer:
+    # Долгоживущий токенайзер поисковых запросов: экстрактор YAKE создаётся один раз,
+    # результаты кэшируются (LRU). Короткие запросы (не длиннее fast_max_words слов) можно
+    # разбирать быстрым режимом без оценки YAKE: n-граммы до 3 слов, не начинающиеся и не
+    # заканчивающиеся стоп-словом, в том же написании, в каком YAKE сохраняет токены при загрузке.
+    # stemmer применяется к словам только в быстром режиме и совместим с токенами в коллекции,
+    # лишь если при загрузке использовался тот же стеммер.
+    word_pattern = re.compile(r"\w+(?:-\w+)*")
+    segment_pattern = re.compile(r"[^\w\s-]+")
+
+    def __init__(self, cache_size: int = 10_000, fast_max_words: int = 0, max_ngram: int = 3,
+                 stemmer: typing.Callable[[str], str] | None = None):
+        self.extractor = build_keyword_extractor()
+        self.stopwords = {word.lower() for word in self.extractor.stopword_set}
+        self.cache_size = cache_size
+        self.fast_max_words = fast_max_words
+        self.max_ngram = max_ngram
+        self.stemmer = stemmer
+        self._cache: collections.OrderedDict[tuple[str, bool], list[str]] = collections.OrderedDict()
+
+    def tokenize(self, text: str, fast: bool | None = None) -> list[str]:
+        text = text.strip()
+        if fast is None:
+            fast = len(text.split()) <= self.fast_max_words
+
+        key = (text, fast)
+        tokens = self._cache.get(key)
+        if tokens is not None:
+            self._cache.move_to_end(key)
+            qdmetrics.metrics.count('tokenizer_cache_hits')
+            return list(tokens)
+
+        with qdmetrics.metrics.timer('tokenize', mode='fast' if fast else 'yake'):
+            tokens = self.fast_tokenize(text) if fast else self.extract(text)
+        if self.cache_size > 0:
+            self._cache[key] = tokens
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+        return list(tokens)
+
+    def extract(self, text: str) -> list[str]:
+        return [token[0] for token in self.extractor.extract_keywords(text)]
+
+    def fast_tokenize(self, text: str) -> list[str]:
+        tokens = []
+        # Как и YAKE, кандидаты не пересекают знаки препинания
+        for segment in self.segment_pattern.split(text):
+            words = self.word_pattern.findall(segment)
+            if self.stemmer is not None:
+                words = [self.stemmer(word) for word in words]
+            for start in range(len(words)):
+                if self._skip_edge(words[start]):
+                    continue
+                for end in range(start, min(start + self.max_ngram, len(words))):
+                    if not self._skip_edge(words[end]):
+                        tokens.append(" ".join(words[start: end + 1]))
+
+        return list(dict.fromkeys(tokens))
+
+    def _skip_edge(self, word: str) -> bool:
+        return len(word) < 3 or word.lower() in self.stopwords or word.isdigit()
 
 
 class FileParser:
-    def __init__(self, max_length: int = None, directory_path: str = None, file_path: str = None):
+    # Реализация clean_html по умолчанию, см. qdhtml.BACKENDS
+    html_backend = 'stream'
+
+    def __init__(self, max_length: int = None, directory_path: str = None, file_path: str = None,
+                 chunker: qdchunker.TextChunker | None = None):
         self.directory_path = directory_path
         self.file_path = file_path
         self.max_length = max_length
+        # Без явного chunker сохраняется прежний лимит max_length в символах
+        if chunker is None:
+            chunker = qdchunker.TextChunker(max_tokens=max_length, count_tokens=len, separator_tokens=1) if max_length \
+                else qdchunker.TextChunker()
+        self.chunker = chunker
         self.points_batch = []
 
-        self.custom_kw_extractor = yake.KeywordExtractor(
-            lan="ru", n=3, dedupLim=0.5, dedupFunc='seqm', windowsSize=1, top=20, features=None)
+        self.custom_kw_extractor = build_keyword_extractor()
 
         if self.directory_path:
             self.__upload_documents_from_directory()
 
     def tokenize_text(self, text: str) -> list:
-        tokens = self.custom_kw_extractor.extract_keywords(text)
+        with qdmetrics.metrics.timer('tokenize', mode='document'):
+            tokens = self.custom_kw_extractor.extract_keywords(text)
         return [token[0] for token in tokens]
 
     @classmethod
-    def clean_html(cls, html, base_url="https://www.1c-uc3.ru", url_transformer=None):
-        if html is None:
-            return None
-
-        soup = bs4.BeautifulSoup(html, 'html.parser')
-        for a_tag in soup.find_all('a'):
-            link = a_tag.get('href')
-            if link:
-                if link.startswith('/') or not (link.startswith('http://') or link.startswith('https://')):
-                    if base_url.endswith('/') and link.startswith('/'):
-                        full_link = base_url + link[1:]
-                    else:
-                        full_link = base_url + ('' if base_url.endswith('/') or link.startswith('/') else '/') + link
-
-                    if url_transformer is not None:
-                        full_link = url_transformer(full_link)
-                    a_tag.replace_with(soup.new_string(full_link))
-                else:
-                    if url_transformer is not None:
-                        link = url_transformer(link)
-                    a_tag.replace_with(soup.new_string(link))
-            else:
-                a_tag.decompose()
-
-        for tag in soup.find_all(['p', 'div', 'span', 'img', 'br']):
-            tag.unwrap()
-
-        for tag in soup.find_all(True):
-            tag.attrs = {}
-
-        result = str(soup)
-        result = result.replace('\xa0', ' ').replace('&nbsp;', ' ')
-        result = result.replace('\r\n', '\n')
-        result = result.replace(' "', " «").replace('"', "»")
-
-        return result
+    def clean_html(cls, html, base_url="https://www.1c-uc3.ru", url_transformer=None, backend=None):
+        return qdhtml.clean_html(html, base_url, url_transformer, backend or cls.html_backend)
+
+    @classmethod
+    def clean_html_many(cls, htmls: typing.Iterable, base_url="https://www.1c-uc3.ru", url_transformer=None,
+                        backend=None, workers: int | None = None, chunksize: int = 32) -> list:
+        # url_transformer при workers != 1 должен быть функцией уровня модуля (передаётся в процессы)
+        clean = functools.partial(cls.clean_html, base_url=base_url, url_transformer=url_transformer,
+                                  backend=backend or cls.html_backend)
+        if workers == 1:
+            return [clean(html) for html in htmls]
+
+        with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            return list(executor.map(clean, htmls, chunksize=chunksize))
 
     def __upload_documents_from_directory(self):
-        for filename in os.listdir(self.directory_path):
-            file_path = os.path.join(self.directory_path, filename)
-            if not os.path.isfile(file_path):
+        for file_path in self.list_files(self.directory_path):
+            self.points_batch.extend(self.parse_file(file_path))
+
+    @staticmethod
+    def list_files(directory_path: str) -> list[str]:
+        # Сортировка делает порядок points одинаковым между запусками и режимами загрузки
+        file_paths = (os.path.join(directory_path, filename) for filename in sorted(os.listdir(directory_path)))
+        return [file_path for file_path in file_paths if os.path.isfile(file_path)]
+
+    def iter_documents(self, directory_path: str | None = None, workers: int | None = None,
+                       chunksize: int = 1) -> typing.Iterator[dict]:
+        if workers == 1:
+            for file_path in self.list_files(directory_path or self.directory_path):
+                yield from self.parse_file(file_path)
+            return
+
+        groups = self.__group_files(directory_path, chunksize)
+        # Впереди держим ограниченное число задач, результаты отдаём строго в порядке файлов
+        max_pending = 2 * (workers or os.cpu_count() or 1)
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker, initargs=(self.chunker,)) as executor:
+            pending = collections.deque()
+            for group in groups:
+                pending.append(executor.submit(_parse_files, group))
+                if len(pending) >= max_pending:
+                    for points in pending.popleft().result():
+                        yield from points
+            while pending:
+                for points in pending.popleft().result():
+                    yield from points
+
+    async def aiter_documents(self, directory_path: str | None = None, workers: int | None = None,
+                              chunksize: int = 1) -> typing.AsyncIterator[dict]:
+        groups = self.__group_files(directory_path, chunksize)
+        max_pending = 2 * (workers or os.cpu_count() or 1)
+        loop = asyncio.get_running_loop()
+        with concurrent.futures.ProcessPoolExecutor(
+                max_workers=workers, initializer=_init_worker, initargs=(self.chunker,)) as executor:
+            pending = collections.deque()
+            try:
+                for group in groups:
+                    pending.append(loop.run_in_executor(executor, _parse_files, group))
+                    if len(pending) >= max_pending:
+                        for points in await pending.popleft():
+                            for point in points:
+                                yield point
+                while pending:
+                    for points in await pending.popleft():
+                        for point in points:
+                            yield point
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def __group_files(self, directory_path: str | None, chunksize: int) -> list[list[str]]:
+        file_paths = self.list_files(directory_path or self.directory_path)
+        return [file_paths[i: i + chunksize] for i in range(0, len(file_paths), chunksize)]
+
+    def parse_file(self, file_path: str) -> list[dict]:
+        filename = os.path.basename(file_path)
+        points = []
+
+        with open(file_path, 'r', encoding='utf-8') as f:
+            content = f.read()
+
+        chunk_index = 0
+        for idx_block, idx_chunk, chunk in self.chunker.chunk_document(content):
+            if len(chunk) < 100 and 'http' not in chunk:
                 continue
 
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content = f.read()
-
-            blocks = []
-            if len(content) > 512:
-                header_matches = list(re.finditer(r'^h[2-3]\..*', content, flags=re.MULTILINE))
-
-                if header_matches:
-                    if len(header_matches) > 1:
-                        end_pos = header_matches[1].start()
-                    else:
-                        end_pos = len(content)
-                    first_block = content[0:end_pos].strip()
-                    blocks.append(first_block)
-
-                    for i in range(1, len(header_matches)):
-                        start = header_matches[i].start()
-                        if i + 1 < len(header_matches):
-                            end = header_matches[i + 1].start()
-                        else:
-                            end = len(content)
-                        block = content[start:end].strip()
-                        blocks.append(block)
-                else:
-                    blocks.append(content.strip())
-            else:
-                blocks.append(content.strip())
-
-            for idx_block, block in enumerate(blocks):
-                raw_chunks = self.__smart_chunk_text(block.strip())
-                merged_chunks = self.__merge_chunks(raw_chunks)
-
-                for idx_chunk, chunk in enumerate(merged_chunks):
-                    if len(chunk) < 100 and 'http' not in chunk:
-                        continue
-
-                    project_name, wiki_name = filename[:-4].split("()")
-                    wiki_name = wiki_name.rsplit('.')[0]
-
-                    self.points_batch.append({
-                        "source": filename,
-                        "type_source": 'текстовый файл',
-                        "content": chunk.lower(),
-                        "title": f"{project_name} {wiki_name} - часть {idx_chunk+1}",
-                        "tokens": self.tokenize_text(chunk),
-                        "project": project_name,
-                        "name": wiki_name,
-                    })
-
-                    logging.debug(f"Загружен {filename} часть {idx_chunk + 1}.")
-
-    def __smart_chunk_text(self, text: str):
-        paragraphs = text.split("\n\n")
-        final_chunks = []
-
-        for paragraph in paragraphs:
-            if len(paragraph) <= self.max_length:
-                final_chunks.append(paragraph)
-            else:
-                lines = paragraph.split("\n")
-                for line in lines:
-                    if len(line) <= self.max_length:
-                        final_chunks.append(line)
-                    else:
-                        words = line.split()
-                        tmp = []
-                        count = 0
-                        for w in words:
-                            if count + len(w) < self.max_length:
-                                tmp.append(w)
-                                count += len(w) + 1
-                            else:
-                                final_chunks.append(" ".join(tmp))
-                                tmp = [w]
-                                count = len(w)
-                        if tmp:
-                            final_chunks.append(" ".join(tmp))
-
-        return final_chunks
-
-    def __merge_chunks(self, chunks):
-        merged_chunks = []
-        current_chunk = ""
-
-        for chunk in chunks:
-            if len(current_chunk) + len(chunk) + (1 if current_chunk else 0) <= self.max_length:
-                current_chunk += (" " + chunk if current_chunk else chunk)
-            else:
-                merged_chunks.append(current_chunk)
-                current_chunk = chunk
-
-        if current_chunk:
-            merged_chunks.append(current_chunk)
-
-        return merged_chunks
+            project_name, wiki_name = filename[:-4].split("()")
+            wiki_name = wiki_name.rsplit('.')[0]
+
+            points.append({
+                "source": filename,
+                "type_source": 'текстовый файл',
+                "content": chunk.lower(),
+                "title": f"{project_name} {wiki_name} - часть {idx_chunk+1}",
+                "tokens": self.tokenize_text(chunk),
+                "project": project_name,
+                "name": wiki_name,
+                "chunk_index": chunk_index,
+            })
+            chunk_index += 1
+
+            logging.debug(f"Загружен {filename} часть {idx_chunk + 1}.")
+
+        return points
+
+
+_worker_parser: FileParser | None = None
+
+
+def _init_worker(chunker: qdchunker.TextChunker):
+    global _worker_parser
+    _worker_parser = FileParser(chunker=chunker)
+
+
+def _parse_files(file_paths: list[str]) -> list[list[dict]]:
+    return [_worker_parser.parse_file(file_path) for file_path in file_paths]
@@ -0,0 +1,220 @@
+import asyncio
+import collections
+import logging
+import random
+import time
+import typing
+
+
+def is_rate_limit_error(error: BaseException) -> bool:
+    status_code = getattr(error, 'status_code', None)
+    if status_code is None:
+        status_code = getattr(getattr(error, 'response', None), 'status_code', None)
+    return status_code == 429 or type(error).__name__ == 'RateLimitError'
+
+
+def get_retry_after(error: BaseException) -> float | None:
+    headers = getattr(getattr(error, 'response', None), 'headers', None)
+    if not headers:
+        return None
+    try:
+        return float(headers.get('retry-after'))
+    except (TypeError, ValueError):
+        return None
+
+
+class EmbeddingScheduler:
+    # Общий для нескольких VectorInfo планировщик: ограничивает число одновременных запросов
+    # и укладывается в бюджеты rpm/tpm по скользящему окну. На 429 ждёт с джиттером и снижает
+    # долю бюджета (rate_factor), после успешных запросов постепенно возвращает её обратно.
+
+    window = 60.
+
+    def __init__(self, max_concurrency: int = 4, rpm: int | None = None, tpm: int | None = None,
+                 max_retries: int = 8, base_delay: float = 1., max_delay: float = 60.,
+                 slowdown: float = 0.5, recovery: float = 0.02, min_rate_factor: float = 0.05):
+        self.max_concurrency = max_concurrency
+        self.rpm = rpm
+        self.tpm = tpm
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.slowdown = slowdown
+        self.recovery = recovery
+        self.min_rate_factor = min_rate_factor
+        self.rate_factor = 1.
+
+        self.requests = 0
+        self.tokens = 0
+        self.rate_limited = 0
+
+        self._in_flight = 0
+        self._condition = asyncio.Condition()
+        self._budget_lock = asyncio.Lock()
+        self._history: collections.deque[tuple[float, int]] = collections.deque()
+        self._history_tokens = 0
+
+    @property
+    def concurrency_limit(self) -> int:
+        return max(1, round(self.max_concurrency * self.rate_factor))
+
+    async def run(self, func: typing.Callable[..., typing.Awaitable], *args, tokens: int = 0):
+        attempt = 0
+        while True:
+            await self._enter()
+            try:
+                await self._acquire_budget(tokens)
+                result = await func(*args)
+            except Exception as error:
+                if not is_rate_limit_error(error) or attempt >= self.max_retries:
+                    raise
+                attempt += 1
+                self.rate_limited += 1
+                self._slow_down()
+                delay = self._backoff(attempt, get_retry_after(error))
+            else:
+                self._speed_up()
+                return result
+            finally:
+                await self._leave()
+
+            logging.warning(f"Превышен лимит запросов к провайдеру эмбеддингов, повтор {attempt} "
+                            f"через {delay:.1f} с (доля бюджета {self.rate_factor:.2f}).")
+            await asyncio.sleep(delay)
+
+    async def _enter(self):
+        async with self._condition:
+            await self._condition.wait_for(lambda: self._in_flight < self.concurrency_limit)
+            self._in_flight += 1
+
+    async def _leave(self):
+        async with self._condition:
+            self._in_flight -= 1
+            self._condition.notify_all()
+
+    async def _acquire_budget(self, tokens: int):
+        async with self._budget_lock:
+            while True:
+                now = time.monotonic()
+                while self._history and now - self._history[0][0] >= self.window:
+                    _, old_tokens = self._history.popleft()
+                    self._history_tokens -= old_tokens
+
+                if self._fits_budget(tokens):
+                    self._history.append((now, tokens))
+                    self._history_tokens += tokens
+                    self.requests += 1
+                    self.tokens += tokens
+                    return
+
+                await asyncio.sleep(self._history[0][0] + self.window - now)
+
+    def _fits_budget(self, tokens: int) -> bool:
+        # В пустое окно пропускаем любой запрос, даже если он один больше бюджета
+        if not self._history:
+            return True
+        if self.rpm is not None and len(self._history) + 1 > self.rpm * self.rate_factor:
+            return False
+        if self.tpm is not None and self._history_tokens + tokens > self.tpm * self.rate_factor:
+            return False
+        return True
+
+    def _backoff(self, attempt: int, retry_after: float | None) -> float:
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempt - 1))
+        delay = random.uniform(delay / 2, delay)
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+    def _slow_down(self):
+        self.rate_factor = max(self.min_rate_factor, self.rate_factor * self.slowdown)
+
+    def _speed_up(self):
+        if self.rate_factor < 1.:
+            self.rate_factor = min(1., self.rate_factor + self.recovery)
+
+
+class MicroBatcher:
+    # Склеивает одновременные вызовы: элементы, пришедшие в течение max_wait секунд или пока их
+    # не набралось max_batch_size, уходят одним вызовом func(items), а результаты раздаются
+    # вызывающим в исходном порядке. func должна возвращать по одному результату на элемент.
+    # Запрос больше max_batch_size выполняется отдельным вызовом целиком.
+    def __init__(self, func: typing.Callable[[list], typing.Awaitable[list]], max_batch_size: int = 256,
+                 max_wait: float = 0.005):
+        if max_batch_size <= 0:
+            raise ValueError("max_batch_size должен быть положительным.")
+        if max_wait < 0:
+            raise ValueError("max_wait не может быть отрицательным.")
+        self.func = func
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+
+        self.calls = 0
+        self.batches = 0
+        self.items = 0
+
+        self._pending: list[tuple[list, asyncio.Future]] = []
+        self._pending_size = 0
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+
+    async def submit(self, items: list) -> list:
+        if not items:
+            return []
+        loop = asyncio.get_running_loop()
+        self.calls += 1
+        if self._pending_size + len(items) > self.max_batch_size:
+            self._flush()
+
+        future = loop.create_future()
+        self._pending.append((items, future))
+        self._pending_size += len(items)
+        if self._pending_size >= self.max_batch_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.max_wait, self._flush)
+        return await future
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        if not self._pending:
+            return
+
+        pending = self._pending
+        self._pending = []
+        self._pending_size = 0
+        task = asyncio.ensure_future(self._run(pending))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, pending: list[tuple[list, asyncio.Future]]):
+        items = [item for part, _ in pending for item in part]
+        self.batches += 1
+        self.items += len(items)
+        try:
+            results = await self.func(items)
+        except asyncio.CancelledError:
+            for _, future in pending:
+                future.cancel()
+            raise
+        except Exception as error:
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        if len(results) != len(items):
+            error = ValueError(f"Ожидалось {len(items)} результатов, получено {len(results)}.")
+            for _, future in pending:
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        # Отменённые вызывающие просто не получают свою часть
+        start = 0
+        for part, future in pending:
+            if not future.done():
+                future.set_result(results[start: start + len(part)])
+            start += len(part)
@@ -0,0 +1,152 @@
+import collections
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+import qdrant_client.models
+
+
+TOKEN_PATTERN = re.compile(r"\w+", flags=re.UNICODE)
+
+
+def tokenize(text: str) -> list[str]:
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if len(token) > 1]
+
+
+class SparseVectorInfo:
+    # Лексический канал для hybrid_search: BM25-веса по словарю терминов, который накапливается
+    # локально при записи points и хранится в JSON (vocabulary_path). Документ кодируется TF-частью
+    # BM25, IDF терминов считает сам Qdrant (Modifier.IDF) по фактически записанным points, поэтому
+    # повторная векторизация и удаление документов не искажают его. Средняя длина документа
+    # по-прежнему копится локально: повторы её почти не сдвигают.
+    model = "bm25"
+
+    def __init__(self, name_for_embed: str, name: str = "bm25", vocabulary_path: str | None = None,
+                 k1: float = 1.2, b: float = 0.75, save_interval: float = 30.):
+        self.name = name
+        self.name_for_embed = name_for_embed
+        self.vocabulary_path = vocabulary_path
+        self.k1 = k1
+        self.b = b
+        # Во время загрузки словарь сохраняется не чаще раза в save_interval секунд,
+        # в конце add_points/update_points/ingest_file - всегда (QdClient.save_vocabulary)
+        self.save_interval = save_interval
+
+        self.vocabulary: dict[str, int] = {}
+        self.doc_count = 0
+        self.total_length = 0
+        self.version = 0
+        self._saved_version = 0
+        self._snapshot_version = 0
+        self._snapshot_at = time.monotonic()
+        self._save_lock = threading.Lock()
+
+        if vocabulary_path and os.path.exists(vocabulary_path):
+            self.load()
+
+    @property
+    def average_length(self) -> float:
+        return self.total_length / self.doc_count if self.doc_count else 1.
+
+    def vector_params(self) -> qdrant_client.models.SparseVectorParams:
+        return qdrant_client.models.SparseVectorParams(modifier=qdrant_client.models.Modifier.IDF)
+
+    def fit(self, texts: list[str | None]):
+        fitted = 0
+        for text in texts:
+            if not text:
+                continue
+            tokens = tokenize(text)
+            fitted += 1
+            self.doc_count += 1
+            self.total_length += len(tokens)
+            for token in tokens:
+                if token not in self.vocabulary:
+                    self.vocabulary[token] = len(self.vocabulary)
+        if fitted:
+            self.version += 1
+
+    def encode_document(self, text: str | None) -> qdrant_client.models.SparseVector | None:
+        if not text:
+            return None
+
+        counts = collections.Counter(tokenize(text))
+        length_norm = self.k1 * (1 - self.b + self.b * sum(counts.values()) / self.average_length)
+        weights = {}
+        for token, tf in counts.items():
+            index = self.vocabulary.get(token)
+            if index is not None:
+                weights[index] = tf * (self.k1 + 1) / (tf + length_norm)
+
+        return self._to_sparse(weights)
+
+    def encode_query(self, text: str) -> qdrant_client.models.SparseVector | None:
+        # Вес термина запроса - 1, Qdrant умножает его на IDF по коллекции
+        weights = {}
+        for token in set(tokenize(text)):
+            index = self.vocabulary.get(token)
+            if index is not None:
+                weights[index] = 1.
+
+        return self._to_sparse(weights)
+
+    @staticmethod
+    def _to_sparse(weights: dict[int, float]) -> qdrant_client.models.SparseVector | None:
+        if not weights:
+            return None
+        indices = sorted(weights)
+        return qdrant_client.models.SparseVector(indices=indices, values=[weights[index] for index in indices])
+
+    def needs_save(self, force: bool = False) -> bool:
+        if not self.vocabulary_path or self.version == self._snapshot_version:
+            return False
+        return force or time.monotonic() - self._snapshot_at >= self.save_interval
+
+    def snapshot(self) -> dict:
+        # Копия состояния для save в другом потоке: fit тем временем может менять словарь.
+        # Копирование - O(размер словаря), поэтому снимки делаются только при needs_save
+        self._snapshot_version = self.version
+        self._snapshot_at = time.monotonic()
+        return {
+            'version': self.version,
+            'doc_count': self.doc_count,
+            'total_length': self.total_length,
+            'vocabulary': dict(self.vocabulary),
+        }
+
+    def save(self, snapshot: dict | None = None):
+        if not self.vocabulary_path:
+            return
+        if snapshot is None:
+            snapshot = self.snapshot()
+
+        # Параллельные сохранения идут по очереди, более старый снимок не перезаписывает новый
+        with self._save_lock:
+            if snapshot['version'] < self._saved_version:
+                return
+            directory = os.path.dirname(os.path.abspath(self.vocabulary_path))
+            fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f"{os.path.basename(self.vocabulary_path)}.",
+                                            suffix=".tmp")
+            try:
+                with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                    json.dump({key: value for key, value in snapshot.items() if key != 'version'},
+                              f, ensure_ascii=False)
+                os.replace(tmp_path, self.vocabulary_path)
+            except BaseException:
+                os.unlink(tmp_path)
+                raise
+            self._saved_version = snapshot['version']
+
+    def load(self):
+        with open(self.vocabulary_path, 'r', encoding='utf-8') as f:
+            data = json.load(f)
+        self.doc_count = data['doc_count']
+        self.total_length = data['total_length']
+        # В старом формате словаря термин хранился как [индекс, df]
+        self.vocabulary = {token: entry[0] if isinstance(entry, list) else entry
+                           for token, entry in data['vocabulary'].items()}
+        logging.info(f"Загружен словарь '{self.name}': {len(self.vocabulary)} терминов, {self.doc_count} документов.")
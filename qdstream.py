@@ -0,0 +1,149 @@
+import asyncio
+import json
+import logging
+import typing
+
+import qddedup
+import qdoperator
+
+
+class JsonStreamReader:
+    # Инкрементальное чтение JSON-массива (или объекта вида {"id": {...}}) без загрузки файла целиком:
+    # в памяти держится только текущий кусок файла и декодируемая запись.
+    def __init__(self, file: typing.TextIO, chunk_size: int = 1 << 20):
+        self.file = file
+        self.chunk_size = chunk_size
+        self.decoder = json.JSONDecoder()
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+
+    def __iter__(self) -> typing.Iterator[typing.Any]:
+        opening = self.expect("[{")
+        closing = "]" if opening == "[" else "}"
+        if self.peek() == closing:
+            self.pos += 1
+            return
+
+        while True:
+            if opening == "{":
+                self.read_value()
+                self.expect(":")
+            yield self.read_value()
+            if self.expect("," + closing) == closing:
+                return
+
+    def _fill(self):
+        if self.pos:
+            self.buffer = self.buffer[self.pos:]
+            self.pos = 0
+        data = self.file.read(self.chunk_size)
+        if not data:
+            self.eof = True
+        self.buffer += data
+
+    def peek(self) -> str | None:
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in " \t\r\n":
+                self.pos += 1
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if self.eof:
+                return None
+            self._fill()
+
+    def expect(self, chars: str) -> str:
+        char = self.peek()
+        if char is None or char not in chars:
+            raise ValueError(f"Некорректный JSON: ожидался один из символов '{chars}', получено {char!r}")
+        self.pos += 1
+        return char
+
+    def read_value(self) -> typing.Any:
+        self.peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+                self._fill()
+                continue
+
+            # Число на границе куска могло быть прочитано не полностью
+            if end == len(self.buffer) and not self.eof:
+                self._fill()
+                continue
+
+            self.pos = end
+            return value
+
+
+def iter_json_records(path: str, chunk_size: int = 1 << 20) -> typing.Iterator[dict]:
+    with open(path, "r", encoding="utf-8") as file:
+        if path.endswith((".jsonl", ".ndjson")):
+            for line in file:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+        else:
+            yield from JsonStreamReader(file, chunk_size)
+
+
+def read_batch(records: typing.Iterator[dict], type_of_object: typing.Type[qdoperator.DataObject],
+               batch_size: int, stats: dict) -> list[qdoperator.DataObject]:
+    batch = []
+    for record in records:
+        stats['read'] += 1
+        try:
+            batch.append(type_of_object.from_dict(record))
+        except (ValueError, KeyError, TypeError, AttributeError) as error:
+            stats['invalid'] += 1
+            logging.warning(f"Запись {stats['read']} пропущена: {error}")
+            continue
+
+        if len(batch) >= batch_size:
+            break
+
+    return batch
+
+
+async def ingest_file(client: qdoperator.QdClient, path: str, collection_name: str,
+                      batch_size: int = 100, max_pending_batches: int = 4, workers: int = 2,
+                      on_batch: typing.Callable[[int], typing.Any] | None = None,
+                      deduplicator: qddedup.NearDuplicateFilter | None = None) -> dict:
+    config = client.collection_configs.get(collection_name)
+    if config is None:
+        raise ValueError(f"Конфигурация для коллекции '{collection_name}' не найдена.")
+    type_of_object = config["type_of_object"]
+
+    stats = {'read': 0, 'invalid': 0, 'written': 0, 'duplicates': 0}
+    # Ограниченная очередь даёт backpressure: чтение файла ждёт, пока запись в Qdrant не догонит
+    queue: asyncio.Queue[list[qdoperator.DataObject] | None] = asyncio.Queue(maxsize=max_pending_batches)
+    records = iter_json_records(path)
+
+    async def produce():
+        while batch := await asyncio.to_thread(read_batch, records, type_of_object, batch_size, stats):
+            await queue.put(batch)
+        for _ in range(workers):
+            await queue.put(None)
+
+    async def consume():
+        while (batch := await queue.get()) is not None:
+            result = await client.add_points(points_batch=batch, collection_name=collection_name,
+                                             deduplicator=deduplicator, flush_vocabulary=False)
+            stats['written'] += result['points']
+            stats['duplicates'] += result['duplicates']
+            if on_batch is not None:
+                on_batch(len(batch))
+
+    async with qdoperator.task_group() as group:
+        group.create_task(produce())
+        for _ in range(workers):
+            group.create_task(consume())
+
+    await client.save_vocabulary(config.get("sparse_vector"), force=True)
+
+    logging.info(f"Из файла '{path}' прочитано {stats['read']} записей, записано {stats['written']}, "
+                 f"отброшено {stats['invalid']}, почти дубликатов {stats['duplicates']}.")
+    return stats
@@ -0,0 +1,96 @@
+import asyncio
+import json
+import random
+
+import qdrant_client.models
+
+import bench_qdclient
+import qddedup
+import qdoperator
+import qdstream
+
+
+def make_record(index: int, words: list[str], source: str) -> dict:
+    return {
+        'type_source': qdoperator.TypeOfSource.SITE.value,
+        'source': source,
+        'tokens': [],
+        'category_name': "Зарплата",
+        'thread_name': f"Тема {index}",
+        'question': " ".join(words[:20]),
+        'answer': " ".join(words[20:]),
+    }
+
+
+async def ingest_with_links(path: str) -> tuple[dict, list[qdrant_client.models.Record]]:
+    client = qdoperator.QdClient(location=":memory:")
+    vectors = [bench_qdclient.FakeVectorInfo(f"{field}-fake", 8, field, qdoperator.AlexQuestion, latency=0.05)
+               for field in ('question', 'answer')]
+    await client.create_collection("links", vectors, qdoperator.AlexQuestion)
+    deduplicator = qddedup.NearDuplicateFilter(mode=qddedup.MODE_LINK)
+    stats = await qdstream.ingest_file(client, path, "links", batch_size=20, workers=2, deduplicator=deduplicator)
+    records, _ = await client.qdrant.scroll("links", limit=100, with_payload=True)
+    return stats, records
+
+
+def test_link_mode_with_concurrent_workers(tmp_path):
+    # Оригиналы и их почти дубликаты попадают в разные батчи, которые пишутся параллельно:
+    # источники дубликатов должны дописаться к каноническим points после их записи
+    rng = random.Random(0)
+    originals = [[f"слово{rng.randrange(10_000)}" for _ in range(60)] for _ in range(20)]
+    records = [make_record(i, words, f"https://forum.example.ru/{i}") for i, words in enumerate(originals)]
+    records += [make_record(i, [*words, "дополнение"], f"https://mirror.example.ru/{i}")
+                for i, words in enumerate(originals)]
+    path = tmp_path / "records.jsonl"
+    path.write_text("\n".join(json.dumps(record, ensure_ascii=False) for record in records), encoding="utf-8")
+
+    stats, points = asyncio.run(ingest_with_links(str(path)))
+
+    assert stats['written'] == 20
+    assert stats['duplicates'] == 20
+    assert len(points) == 20
+    linked = {point.payload['source']: point.payload.get('merged_sources') for point in points}
+    for i in range(20):
+        assert linked[f"https://forum.example.ru/{i}"] == [f"https://mirror.example.ru/{i}"]
+
+
+async def link_then_update() -> tuple[list, list]:
+    client = qdoperator.QdClient(location=":memory:")
+    vectors = [bench_qdclient.FakeVectorInfo(f"{field}-fake", 8, field, qdoperator.AlexQuestion)
+               for field in ('question', 'answer')]
+    await client.create_collection("links", vectors, qdoperator.AlexQuestion)
+    rng = random.Random(1)
+    originals = [[f"слово{rng.randrange(10_000)}" for _ in range(60)] for _ in range(4)]
+    records = [make_record(i, words, f"https://forum.example.ru/{i}") for i, words in enumerate(originals)]
+    duplicates = [make_record(i, [*words, "дополнение"], f"https://mirror.example.ru/{i}")
+                  for i, words in enumerate(originals)]
+    deduplicator = qddedup.NearDuplicateFilter(mode=qddedup.MODE_LINK)
+    await client.add_points(records + duplicates, "links", deduplicator=deduplicator)
+
+    # Ежедневная синхронизация: у двух записей меняется только payload, у двух - векторизуемое поле
+    changed = [dict(record, thread_name="Новая тема") for record in records[:2]]
+    changed += [dict(record, question=record['question'] + " изменено") for record in records[2:]]
+    result = await client.update_points(changed, "links", compare_fields=['source'],
+                                        fields_to_check=['question', 'answer'])
+    points, _ = await client.qdrant.scroll("links", limit=100, with_payload=True)
+    return result, points
+
+
+def test_merged_sources_survive_updates():
+    result, points = asyncio.run(link_then_update())
+
+    assert result == {'updating': 4, 'adding': 0}
+    linked = {point.payload['source']: point.payload.get('merged_sources') for point in points}
+    for i in range(4):
+        assert linked[f"https://forum.example.ru/{i}"] == [f"https://mirror.example.ru/{i}"]
+
+
+def test_drop_mode_records_sources():
+    deduplicator = qddedup.NearDuplicateFilter(mode=qddedup.MODE_DROP)
+    text = " ".join(f"слово{i}" for i in range(40))
+    assert deduplicator.check("a", text, "https://forum.example.ru/1") is None
+    assert deduplicator.check("b", text + " ещё", "https://mirror.example.ru/1") == "a"
+
+    assert deduplicator.merged_sources == {"a": ["https://mirror.example.ru/1"]}
+    assert deduplicator.take_dirty() == {}
+    assert deduplicator.stats()['merged_sources'] == 1
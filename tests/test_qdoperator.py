@@ -0,0 +1,161 @@
+import asyncio
+import datetime
+import json
+import uuid
+
+import pytest
+import qdrant_client.models
+
+import bench_qdclient
+import qdoperator
+import qdstream
+
+
+class FailingVectorInfo(bench_qdclient.FakeVectorInfo):
+    async def _embed_batch(self, texts: list[str], model: str) -> list[list[float]]:
+        raise RuntimeError("модель недоступна")
+
+
+def alex_records(count: int) -> list[dict]:
+    return [{
+        'type_source': qdoperator.TypeOfSource.SITE.value,
+        'source': f"https://forum.example.ru/{i}",
+        'tokens': [],
+        'category_name': "Зарплата",
+        'thread_name': f"Тема {i}",
+        'question': f"Вопрос {i}",
+        'answer': f"Ответ {i}",
+    } for i in range(count)]
+
+
+async def failing_client() -> qdoperator.QdClient:
+    client = qdoperator.QdClient(location=":memory:")
+    vectors = [FailingVectorInfo("question-fake", 8, 'question', qdoperator.AlexQuestion)]
+    await client.create_collection("failing", vectors, qdoperator.AlexQuestion)
+    return client
+
+
+def test_add_points_raises_original_error():
+    # Ошибка эмбеддинга не должна заворачиваться в ExceptionGroup
+    async def run():
+        client = await failing_client()
+        await client.add_points(alex_records(30), "failing", batch_size=10)
+
+    with pytest.raises(RuntimeError, match="модель недоступна"):
+        asyncio.run(run())
+
+
+def test_ingest_file_raises_original_error(tmp_path):
+    path = tmp_path / "records.jsonl"
+    path.write_text("\n".join(json.dumps(record, ensure_ascii=False) for record in alex_records(30)),
+                    encoding="utf-8")
+
+    async def run():
+        client = await failing_client()
+        await qdstream.ingest_file(client, str(path), "failing", batch_size=10)
+
+    with pytest.raises(RuntimeError, match="модель недоступна"):
+        asyncio.run(run())
+
+
+def wiki_chunks(count: int, suffix: str = "") -> list[dict]:
+    return [{
+        'content': f"Раздел {i} инструкции по переносу данных{suffix}",
+        'type_source': qdoperator.TypeOfSource.TXT_FILE.value,
+        'source': "https://redmine.example.ru/wiki/Перенос",
+        'tokens': [],
+        'title': "Перенос данных",
+        'project': "ЗУП",
+        'name': "Перенос",
+        'chunk_index': i,
+    } for i in range(count)]
+
+
+def test_update_points_keeps_chunks_of_one_source():
+    # Все чанки wiki-страницы имеют один source: ключ сравнения различает их по chunk_index
+    async def run():
+        client = qdoperator.QdClient(location=":memory:")
+        vectors = [bench_qdclient.FakeVectorInfo("content-fake", 8, 'content', qdoperator.RedmineWikiObject)]
+        await client.create_collection("wiki", vectors, qdoperator.RedmineWikiObject)
+        first = await client.update_points(wiki_chunks(20), "wiki", compare_fields=['source', 'chunk_index'],
+                                           fields_to_check=['content'])
+        second = await client.update_points(wiki_chunks(20), "wiki", compare_fields=['source', 'chunk_index'],
+                                            fields_to_check=['content'])
+        count = await client.qdrant.count("wiki")
+        return first, second, count.count
+
+    first, second, count = asyncio.run(run())
+
+    assert first == {'updating': 0, 'adding': 20}
+    assert second == {'updating': 0, 'adding': 0}
+    assert count == 20
+
+
+def nomenclature_record(content: str, modified_at: datetime.datetime) -> dict:
+    return {
+        'content': content,
+        'type_source': qdoperator.TypeOfSource.KASKAD.value,
+        'source': "https://kaskad.example.ru/n/42",
+        'n_id': "42",
+        'modified_at': modified_at.strftime('%Y-%m-%dT%H:%M:%S'),
+        'tokens': [],
+    }
+
+
+def test_update_points_for_date_rewrites_unhashed_points():
+    # Point записан до появления payload_hash/embed_hash: более свежая запись должна его обновить
+    old_date = datetime.datetime(2024, 1, 10, 12, 0)
+    new_date = datetime.datetime(2024, 2, 1, 9, 30)
+
+    async def run():
+        client = qdoperator.QdClient(location=":memory:")
+        vector = bench_qdclient.FakeVectorInfo("content-fake", 8, 'content', qdoperator.NomenclatureObjet)
+        await client.create_collection("nomenclature", [vector], qdoperator.NomenclatureObjet)
+        legacy = qdoperator.NomenclatureObjet.from_dict(nomenclature_record("Старое описание", old_date))
+        await client.qdrant.upsert("nomenclature", points=[qdrant_client.models.PointStruct(
+            id=str(uuid.uuid4()), vector={"content-fake": vector.fake_embedding(legacy.content)},
+            payload=dict(legacy))])
+
+        records = [nomenclature_record("Новое описание", new_date)]
+        first = await client.update_points_for_date(records, "nomenclature", 'modified_at',
+                                                    cursor=old_date.timestamp())
+        second = await client.update_points_for_date(records, "nomenclature", 'modified_at',
+                                                     cursor=old_date.timestamp())
+        points, _ = await client.qdrant.scroll("nomenclature", limit=10, with_payload=True)
+        return first, second, points
+
+    first, second, points = asyncio.run(run())
+
+    assert (first['updating'], first['adding']) == (1, 0)
+    assert (second['updating'], second['adding']) == (0, 0)
+    assert len(points) == 1
+    assert points[0].payload['content'] == "Новое описание"
+    assert points[0].payload['payload_hash'] is not None
+
+
+def test_update_points_skips_unchanged_and_updates_payload_only():
+    async def run():
+        client = qdoperator.QdClient(location=":memory:")
+        vectors = [bench_qdclient.FakeVectorInfo(f"{field}-fake", 8, field, qdoperator.AlexQuestion)
+                   for field in ('question', 'answer')]
+        await client.create_collection("alex", vectors, qdoperator.AlexQuestion)
+        records = alex_records(10)
+        await client.add_points(records, "alex")
+        requests = sum(vector.requests for vector in vectors)
+
+        unchanged = await client.update_points(records, "alex", compare_fields=['source'],
+                                               fields_to_check=['question', 'answer'])
+        # Меняется только поле без вектора: записи обновляются без обращения к модели
+        renamed = [dict(record, thread_name="Новая тема") for record in records]
+        payload_only = await client.update_points(renamed, "alex", compare_fields=['source'],
+                                                  fields_to_check=['question', 'answer'])
+        points, _ = await client.qdrant.scroll("alex", limit=100, with_payload=True)
+        return unchanged, payload_only, sum(vector.requests for vector in vectors) - requests, points
+
+    unchanged, payload_only, requests, points = asyncio.run(run())
+
+    assert unchanged == {'updating': 0, 'adding': 0}
+    assert payload_only == {'updating': 10, 'adding': 0}
+    assert requests == 0
+    assert len(points) == 10
+    assert {point.payload['thread_name'] for point in points} == {"Новая тема"}